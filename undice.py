@@ -1,9 +1,22 @@
 import os
 import sys
 import json
+import mmap
+import zlib
+import shutil
+import hashlib
 import argparse
+import tempfile
+import threading
+import traceback
+import weakref
 from math import ceil
-from struct import unpack
+from fnmatch import fnmatch
+from functools import partial
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
+from struct import pack, unpack
 # from time import sleep
 
 try:
@@ -14,6 +27,18 @@ except ImportError:
     "(https://pypi.org/project/Pillow/)"
   )
   raise
+try:
+  import numpy as np
+except ImportError:
+  print(
+    "Please install NumPy module for array manipulation.\n"
+    "(https://pypi.org/project/numpy/)"
+  )
+  raise
+
+import undice_profile
+import undice_unityfs
+from undice_profile import stage
 
 unitypack_in_vogue = 'y'
 # i.e. intention of unitypack being installed
@@ -39,7 +64,8 @@ def _init_parser():
       'for "son_ba.png" or "son_ba.jpg" in the same folder).\n'
       'If JSON: the image file must be named the same as it is in the JSON '
       'file.\n'
-      'If assetbundle: need to use --use-unitypack switch.'
+      'If assetbundle: DicingTextures and their atlases are read from it '
+      'directly.'
     )
   )
   parser.add_argument(
@@ -52,13 +78,278 @@ def _init_parser():
   parser.add_argument(
     '--use-unitypack', action='store_true', help=(
       'Use unitypack module for direct assetbundles manipulation '
-      '(https://github.com/HearthSim/UnityPack) (false by default'
-      ' as it has problems extracting certain images correctly)'
+      '(https://github.com/HearthSim/UnityPack) instead of the built-in '
+      'reader (false by default as it has problems extracting certain images '
+      'correctly, and can\'t read LZ4 compressed bundles)'
+    )
+  )
+  parser.add_argument(
+    '-j', '--jobs', type=int, default=1, help=(
+      'number of files to undice in parallel with a process pool (default 1)'
+      '; output names, including any " (n)" suffixes, stay the same as with '
+      'a single job'
+    )
+  )
+  parser.add_argument(
+    '--engine', choices=('numpy', 'pil'), default='numpy', help=(
+      'how diced blocks are put back together: "numpy" gathers every block '
+      'of a sprite at once from an array of the atlas, "pil" crops and '
+      'pastes block by block (default "numpy")'
+    )
+  )
+  parser.add_argument(
+    '--atlas-cache-mb', type=int, default=512, help=(
+      'memory cap in MB for decoded atlases kept around for reuse by later '
+      'files; least recently used atlases are dropped first (default 512, '
+      'per job)'
+    )
+  )
+  parser.add_argument(
+    '--save-plans', action='store_true', help=(
+      'also save the paste plans compiled from each MVL as '
+      '"<basename>.mvlplan.json" in the output directory; passing that file '
+      'in place of the MVL renders it again without parsing the MVL (not '
+      'with --only, as the plans would be missing the sprites left out)'
+    )
+  )
+  parser.add_argument(
+    '--force', action='store_true', help=(
+      'undice every file again, even those the output directory\'s manifest '
+      'says are unchanged since they were last undiced there'
+    )
+  )
+  parser.add_argument(
+    '--only', type=str, action='append', metavar='PATTERN', help=(
+      'only undice sprites whose name, or name within its output folder '
+      '(e.g. "son_ba/face01"), matches PATTERN (wildcards * ? [...]); may be '
+      'given more than once; the manifest is neither used nor updated'
+    )
+  )
+  parser.add_argument(
+    '--list', action='store_true', help=(
+      'list the sprites in each file (those matching --only, if given) with '
+      'their size, cell or quad count and atlas, without decoding or saving '
+      'any image'
+    )
+  )
+  undice_profile.add_arguments(parser)
+  parser.add_argument(
+    '--no-optimize', action='store_true', help=(
+      "don't use PNG optimize when saving; much faster, somewhat bigger files"
+    )
+  )
+  parser.add_argument(
+    '--png-level', type=int, choices=range(10), metavar='{0-9}', help=(
+      'zlib compression level to save PNGs at instead of optimizing them '
+      '(implies --no-optimize; 6 if --no-optimize is given alone)'
+    )
+  )
+  parser.add_argument(
+    '--save-threads', type=int, default=2, help=(
+      'number of threads encoding and writing PNGs while the next sprites '
+      'are made, 0 to save inline (default 2, per job)'
+    )
+  )
+  parser.add_argument(
+    '--bands', type=int, default=0, metavar='ROWS', help=(
+      'make and save each sprite ROWS rows at a time, so memory taken goes '
+      'with ROWS times sprite width rather than sprite size, for sprites too '
+      'big to hold whole; PNGs are then written by a built-in streaming '
+      'encoder (same pixels, slightly different files) and the numpy engine '
+      'is used (default 0, whole sprites)'
+    )
+  )
+  parser.add_argument(
+    '--dedupe', action='store_true', help=(
+      'within each file, make and save sprites that come out the same (same '
+      'atlas and cells, or same MVL paste plan) only once, hard-linking the '
+      'others\' PNGs to it (copying where hard links aren\'t supported)'
+    )
+  )
+  parser.add_argument(
+    '--shared-atlas', action='store_true', help=(
+      'with -j, undice files one at a time, splitting each one\'s sprites '
+      'between the jobs, which map a single copy of each atlas in shared '
+      'memory instead of decoding their own; for few files with many '
+      'sprites, e.g. big JSONs or MVLs with hundreds of entries'
+    )
+  )
+  parser.add_argument(
+    '--no-scan-cache', action='store_true', help=(
+      'list folders given as fpath afresh, rather than reusing listings '
+      'kept in the output directory for folders unchanged since'
     )
   )
 
   return parser
 
+## atlas caching
+class AtlasCache:
+  # least-recently-used store of decoded atlases (PIL images or arrays), so
+  # that each atlas is decoded once per run no matter how many sprites or
+  # files reference it, as long as it fits within max_bytes; stat_files
+  # keys atlases by their files' size and mtime as well, for caches that
+  # outlive a run (see undice_service.py), so changed files aren't reused
+  def __init__(self, max_bytes=512 * 2**20, stat_files=False):
+    self.max_bytes = max_bytes; self.nbytes = 0
+    self.stat_files = stat_files
+    self.entries = OrderedDict()
+    self.hits = 0; self.misses = 0; self.evictions = 0
+    # held only to look at or change the entries, never while loading
+    self.lock = threading.Lock()
+    # key: Event set once the thread loading it is done, so threads sharing
+    # the cache decode each atlas once between them, and different atlases
+    # at the same time
+    self.loading = dict()
+
+  def get(self, key, loader):
+    while True:
+      with self.lock:
+        if key in self.entries:
+          self.hits += 1
+          self.entries.move_to_end(key)
+          return self.entries[key][0]
+        done = self.loading.get(key)
+        if done is None:
+          self.misses += 1
+          done = self.loading[key] = threading.Event()
+          break
+      # then looks again, loading it after all if that failed
+      done.wait()
+    try:
+      value = loader()
+      if isinstance(value, np.ndarray):
+        nbytes = value.nbytes
+      else:
+        nbytes = value.size[0] * value.size[1] * len(value.getbands())
+      with self.lock:
+        self.entries[key] = (value, nbytes); self.nbytes += nbytes
+        # newest entry is always kept, even if over the cap on its own
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+          _, (_, old_nbytes) = self.entries.popitem(last=False)
+          self.nbytes -= old_nbytes; self.evictions += 1
+    finally:
+      with self.lock:
+        del self.loading[key]
+      done.set()
+    return value
+
+  def get_file_key(self, key):
+    # key, with the size and mtime of the file it names (itself if str,
+    # else its first item) if stat_files
+    path = key if isinstance(key, str) else key[0]
+    if not self.stat_files or not isinstance(path, str):
+      return key
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return key
+    return key, stat.st_size, stat.st_mtime_ns
+
+  def counters(self):
+    with self.lock:
+      return self.hits, self.misses, self.evictions
+
+  def add_counters(self, hits, misses, evictions):
+    # e.g. those of pool workers' caches
+    with self.lock:
+      self.hits += hits; self.misses += misses; self.evictions += evictions
+
+  def stats(self):
+    return '{} hits, {} misses, {} evictions'.format(*self.counters())
+
+class SharedArray(np.ndarray):
+  # array in a multiprocessing.shared_memory block, which pickles as the
+  # block's name, so that other processes map the same memory rather than
+  # get a copy; views of it pickle as plain arrays
+  def __array_finalize__(self, obj):
+    self.shm = None
+
+  def __reduce__(self):
+    if self.shm is None:
+      return np.asarray(self).__reduce__()
+    return attach_shared_array, (self.shm.name, self.shape, self.dtype.str)
+
+def share_array(array):
+  shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+  shared = SharedArray(array.shape, array.dtype, shm.buf)
+  shared[...] = array; shared.shm = shm
+  return shared
+
+# name: (SharedMemory, weakref of its SharedArray) mapped in this process
+attached_arrays = dict()
+
+def attach_shared_array(name, shape, dtype):
+  if name in attached_arrays:
+    array = attached_arrays[name][1]()
+    if array is not None:
+      return array
+  shm = shared_memory.SharedMemory(name)
+  array = SharedArray(shape, dtype, shm.buf); array.shm = shm
+  attached_arrays[name] = (shm, weakref.ref(array))
+  return array
+
+def release_attached_arrays():
+  # unmaps blocks whose arrays are all gone here
+  for name, (shm, ref) in list(attached_arrays.items()):
+    if ref() is None:
+      shm.close()
+      del attached_arrays[name]
+
+class SharedAtlasCache(AtlasCache):
+  # AtlasCache putting atlas arrays in shared memory as SharedArrays; blocks
+  # of atlases dropped from it are only freed by release(), as sprites still
+  # queued in other processes may need them till then
+  def __init__(self, max_bytes=512 * 2**20):
+    super().__init__(max_bytes)
+    self.blocks = list()
+
+  def get(self, key, loader):
+    return super().get(key, lambda: self.share(loader()))
+
+  def share(self, value):
+    if not isinstance(value, np.ndarray):
+      return value
+    shared = share_array(value)
+    self.blocks.append(shared.shm)
+    return shared
+
+  def release(self, everything=False):
+    kept = set() if everything else set(
+      id(value.shm) for value, _ in self.entries.values()
+      if isinstance(value, SharedArray)
+    )
+    blocks = self.blocks; self.blocks = list()
+    for shm in blocks:
+      if id(shm) in kept:
+        self.blocks.append(shm)
+        continue
+      try:
+        shm.close()
+      except BufferError: # still viewed here; unmapped when that goes
+        pass
+      shm.unlink()
+
+  def close(self):
+    self.entries.clear(); self.nbytes = 0
+    self.release(everything=True)
+
+def open_atlas(img_path):
+  with stage('decode') as counts:
+    im = Image.open(img_path)
+    im.load()
+    counts['pixels'] = im.size[0] * im.size[1]
+    if undice_profile.profiler:
+      counts['bytes_in'] = os.path.getsize(img_path)
+  return im
+
+def load_atlas(atlas_cache, key, loader, engine='numpy'):
+  # atlas in the form the engine works with, decoded at most once per cache
+  key = atlas_cache.get_file_key(key)
+  if engine == 'numpy':
+    return atlas_cache.get(('array', key), lambda: get_atlas_array(loader()))
+  return atlas_cache.get(('image', key), loader)
+
 ## undicing
 def get_assetbundle_items(f_obj):
   magic = f_obj.read(8); f_obj.seek(0)
@@ -96,6 +387,9 @@ def get_assetbundle_items(f_obj):
   assert len(assets) == 1
   return assets[0].objects.items()
 
+def _get_unitypack_image(texture):
+  return texture.image.transpose(Image.FLIP_TOP_BOTTOM)
+
 def get_dicentex_from_assetbundle(f_obj):
   textures = dict(); dicings = list()
   items = get_assetbundle_items(f_obj)
@@ -104,12 +398,30 @@ def get_dicentex_from_assetbundle(f_obj):
       # problems sometimes pop up here; if image read successful, they seem to
       # be upside-down while others like DXT5Crunched format are unsuccessful
       texture = dictitem[1].read()
-      textures[texture.name] = texture.image.transpose(Image.FLIP_TOP_BOTTOM)
+      # decoding is left until (and if) a dicing asks for it
+      textures[texture.name] = partial(_get_unitypack_image, texture)
     elif dictitem[1].type == 'DicingTextures':
       dicings.append(dictitem[1].read())
   return dicings, textures
 
-def get_jpg_or_png(dirname, basename):
+def get_bundle_dicentex(f_obj, use_unitypack=False):
+  # (dicings, textures) from the built-in bundle reader, or unitypack's
+  if not use_unitypack:
+    with stage('parse') as counts:
+      dicentex = undice_unityfs.get_dicentex_from_bundle(f_obj)
+      counts['bytes_in'] = f_obj.tell()
+    return dicentex
+  if unitypack_in_vogue == 'y':
+    return get_dicentex_from_assetbundle(f_obj)
+  return [], dict()
+
+def get_jpg_or_png(dirname, basename, dir_images=None):
+  # dir_images, as filled in by scan_fpaths(), is looked in first; the
+  # filesystem is only asked if that doesn't find it (e.g. case differs)
+  images = dir_images.get(os.path.abspath(dirname), ()) if dir_images else ()
+  for ext in ('.png', '.jpg'):
+    if basename + ext in images:
+      return os.path.join(dirname, basename + ext)
   if os.path.isfile(os.path.join(dirname, basename + '.png')):
     ext = '.png'
   elif os.path.isfile(os.path.join(dirname, basename + '.jpg')):
@@ -120,62 +432,503 @@ def get_jpg_or_png(dirname, basename):
     )
   return os.path.join(dirname, basename + ext)
 
+def get_mvl_basename(infile_path):
+  # "son_ba_.mvl" goes with "son_ba.png" or "son_ba.jpg"
+  basename = os.path.splitext(os.path.basename(infile_path))[0]
+  if basename[-1] == '_':
+    basename = basename[:-1]
+  return basename
+
+def get_final_name(outfold, name, ext='.png', reserved=()):
+  # reserved holds names already handed out but maybe not yet written
+  def taken(path):
+    return path in reserved or os.path.isfile(path)
+  if taken(os.path.join(outfold, name + ext)):
+    n = 1
+    while taken(os.path.join(outfold, name + f' ({n}){ext}')):
+      n += 1
+    return os.path.join(outfold, name + f' ({n}){ext}')
+  return os.path.join(outfold, name + ext)
+
+## saving
+def get_png_save_kwargs(optimize=True, png_level=None):
+  if png_level is not None:
+    return {'compress_level': png_level}
+  if optimize:
+    return {'optimize': True}
+  return {}
+
+class PNGWriter:
+  # write-behind stage: images handed to submit() are encoded and written by
+  # a thread pool while the caller goes on making the next ones; past
+  # max_pending unwritten images submit() blocks, so memory stays bounded
+  # whether submit() is to be given DeferredSprites
+  deferred = False
+
+  def __init__(self, threads=2, max_pending=None, save_kwargs=None):
+    self.threads = threads
+    self.max_pending = max_pending or 2 * max(threads, 1)
+    self.save_kwargs = {'optimize': True} if save_kwargs is None else \
+      save_kwargs
+    # started on first submit, so writers only lending their settings to
+    # pool workers never start any threads
+    self.pool = None
+    self.slots = threading.BoundedSemaphore(self.max_pending)
+    self.pending = list()
+    # every name handed out, so names are settled by the submitting thread
+    # alone and never race with writes still in flight
+    self.reserved = set()
+
+  def get_final_name(self, outfold, name, ext='.png'):
+    final_name = get_final_name(outfold, name, ext, self.reserved)
+    self.reserved.add(final_name)
+    return final_name
+
+  def discard(self, final_names):
+    # removes files saved under names handed out, letting the names go
+    for final_name in final_names:
+      self.reserved.discard(final_name)
+      if os.path.isfile(final_name):
+        os.remove(final_name)
+
+  def save(self, im, final_name, file=None):
+    with stage('save', file) as counts:
+      im.save(final_name, **self.save_kwargs)
+      counts['pixels'] = im.size[0] * im.size[1]
+      if undice_profile.profiler:
+        counts['bytes_out'] = os.path.getsize(final_name)
+
+  def submit(self, im, final_name):
+    if not self.threads:
+      self.save(im, final_name)
+      return
+    if self.pool is None:
+      self.pool = ThreadPoolExecutor(self.threads)
+    self.slots.acquire()
+    try:
+      future = self.pool.submit(
+        self.save, im, final_name, undice_profile.get_file()
+      )
+    except BaseException:
+      self.slots.release()
+      raise
+    future.add_done_callback(lambda _: self.slots.release())
+    self.pending.append(future)
+
+  def flush(self, ignore_errors=False):
+    # waits for everything submitted so far; raises the first save error
+    pending = self.pending; self.pending = list()
+    errors = [future.exception() for future in pending]
+    errors = [error for error in errors if error is not None]
+    if errors and not ignore_errors:
+      raise errors[0]
+
+  def close(self):
+    try:
+      self.flush()
+    finally:
+      if self.pool:
+        self.pool.shutdown()
+
+def write_png(f, size, bands, compress_level=6):
+  # streams an 8-bit RGBA PNG into f from bands of its rows, top to bottom,
+  # given as (rows, width, 4) uint8 arrays; only one band is held at a time
+  width, height = size
+
+  def write_chunk(tag, data):
+    f.write(pack('>I', len(data)) + tag + data)
+    f.write(pack('>I', zlib.crc32(data, zlib.crc32(tag))))
+
+  f.write(b'\x89PNG\r\n\x1a\n')
+  write_chunk(b'IHDR', pack('>2I5B', width, height, 8, 6, 0, 0, 0))
+  compressor = zlib.compressobj(compress_level)
+  above = np.zeros(width * 4, dtype=np.int16)
+  # compressed data goes out in IDAT chunks of 64KB or so
+  data = b''
+  # filtering takes many times the memory of the rows it works on, so it's
+  # done some 256KB of rows at a time whatever the band height
+  step = max(1, 2**18 // (width * 4))
+  for band in bands:
+    band = band.reshape(len(band), width * 4)
+    for y in range(0, len(band), step):
+      rows = band[y:y + step].astype(np.int16)
+      data += compressor.compress(_filter_png_rows(rows, above))
+      if len(data) >= 2**16:
+        write_chunk(b'IDAT', data); data = b''
+      above = rows[-1]
+  write_chunk(b'IDAT', data + compressor.flush())
+  write_chunk(b'IEND', b'')
+
+def _filter_png_rows(rows, above):
+  # filter type byte + filtered bytes for rows (int16, 4 bytes a pixel)
+  # below the row above; each row gets whichever of the five PNG filters
+  # leaves the least sum of bytes taken as signed, as libpng picks them
+  up = np.vstack((above[None], rows[:-1]))
+  left = np.zeros_like(rows); left[:, 4:] = rows[:, :-4]
+  upleft = np.zeros_like(rows); upleft[:, 4:] = up[:, :-4]
+  p = left + up - upleft
+  pa = np.abs(p - left); pb = np.abs(p - up); pc = np.abs(p - upleft)
+  paeth = np.where(
+    (pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, upleft)
+  )
+  # wraps around to bytes, as filters work modulo 256
+  filtered = np.stack((
+    rows, rows - left, rows - up, rows - ((left + up) >> 1), rows - paeth
+  )).astype(np.uint8)
+  # abs() of -128 as int8 stays -128, which is 128 again as uint8
+  costs = np.stack([
+    np.abs(candidate.view(np.int8)).view(np.uint8).sum(axis=1)
+    for candidate in filtered
+  ])
+  choice = costs.argmin(axis=0)
+  out = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+  out[:, 0] = choice
+  out[:, 1:] = filtered[choice, np.arange(len(rows))]
+  return out.tobytes()
+
+class BandedSprite:
+  # stands in for a sprite's PILimg with --bands: its size is known up front,
+  # and save() makes its pixels band by band as they're written, so no more
+  # than a band of it is ever held; make_band(y0, y1) gives rows y0 to y1 as
+  # a (y1 - y0, width, 4) uint8 array
+  def __init__(self, size, band_height, make_band):
+    self.size = size; self.band_height = band_height
+    self.make_band = make_band
+    # bands are made on the writer's threads, so remember whose they are
+    self.file = undice_profile.get_file()
+
+  def iter_bands(self):
+    height = self.size[1]
+    for y0 in range(0, height, self.band_height):
+      y1 = min(y0 + self.band_height, height)
+      with stage('reconstruct', self.file) as counts:
+        band = self.make_band(y0, y1)
+        counts['pixels'] = band.shape[0] * band.shape[1]
+      yield band
+
+  def save(self, fp, optimize=False, compress_level=None):
+    # takes PNGWriter's save_kwargs; optimize means zlib's best compression
+    if compress_level is None:
+      compress_level = 9 if optimize else 6
+    if isinstance(fp, (str, os.PathLike)):
+      with open(fp, 'wb') as f:
+        write_png(f, self.size, self.iter_bands(), compress_level)
+    else:
+      write_png(fp, self.size, self.iter_bands(), compress_level)
+
+  def to_image(self):
+    return Image.fromarray(np.concatenate(list(self.iter_bands())), 'RGBA')
+
+def link_or_copy(src, dst):
+  # hard link where the filesystem has them, else a copy
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copyfile(src, dst)
+
+class SpriteAlias:
+  # yielded in place of a sprite's image when it'd render the same as the
+  # earlier sprite called name, so that it's made and saved only once
+  def __init__(self, name):
+    self.name = name
+
+def get_render_key(*parts, data=b''):
+  # what a sprite is rendered from, e.g. its atlas and cells, hashed
+  digest = hashlib.sha1(repr(parts).encode())
+  digest.update(data)
+  return digest.hexdigest()
+
+def check_rendered(renders, name, *parts, data=b''):
+  # SpriteAlias for the sprite renders (render key: name) has rendered the
+  # same as name already, else None with name put down for later ones
+  if renders is None:
+    return None
+  render_key = get_render_key(*parts, data=data)
+  if render_key in renders:
+    return SpriteAlias(renders[render_key])
+  renders[render_key] = name
+  return None
+
+class DeferredSprite:
+  # stands in for a sprite's PILimg until it's saved, possibly by another
+  # process (see --shared-atlas); render() gives (name, PILimg)
+  def __init__(self, size, render):
+    self.size = size; self.render = render
+    self.file = undice_profile.get_file()
+
+  def to_image(self):
+    with stage('reconstruct', self.file) as counts:
+      im = self.render()[1]
+      counts['pixels'] = im.size[0] * im.size[1]
+    return im
+
+  def save(self, fp, **save_kwargs):
+    self.to_image().save(fp, **save_kwargs)
+
+def get_atlas_size(atlas):
+  # (width, height) of atlas as either PILimg or array from get_atlas_array
+  if isinstance(atlas, np.ndarray):
+    return atlas.shape[1], atlas.shape[0]
+  return atlas.size
+
+def iter_undiced(
+  f, infile_path, engine='numpy', atlas_cache=None, use_unitypack=False,
+  plans_callback=None, wanted=None, band_height=None, renders=None,
+  defer=False, mvl_cache=None, dir_images=None
+):
+  # returns iterator of (name, im) for each sprite in opened infile f, with
+  # names relative to the output folder, or None if f isn't MVL/JSON/bundle;
+  # sprites are only made as the iterator is advanced; plans_callback gets
+  # (plans, img_path, atlas_size, basename) for every MVL compiled; if given,
+  # only sprites whose name wanted(name) is true for are made, and atlases
+  # none of them use aren't decoded; with band_height, ims are BandedSprites
+  # of that many rows a band, cut out of atlas arrays whatever the engine;
+  # renders, a dict, has sprites rendering the same as an earlier one come
+  # as a SpriteAlias of it instead; defer has ims be DeferredSprites, to be
+  # rendered as they're saved; mvl_cache, a dict or alike, keeps MVL entries
+  # parsed, by file path, size and mtime, for later calls; dir_images is as
+  # for get_jpg_or_png
+  if atlas_cache is None:
+    atlas_cache = AtlasCache()
+  if band_height or defer:
+    engine = 'numpy'
+  magic = f.read(8); f.seek(0)
+  if magic == b'UnityFS\x00':
+    dicings, textures = get_bundle_dicentex(f, use_unitypack)
+    return _iter_undice_dicings(
+      dicings, textures, engine, atlas_cache, infile_path, wanted,
+      band_height, renders, defer
+    )
+  elif magic[:4] == b'MVL1':
+    basename = get_mvl_basename(infile_path)
+    img_path = get_jpg_or_png(
+      os.path.dirname(infile_path), basename, dir_images
+    )
+    entries = None
+    if mvl_cache is not None:
+      stat = os.fstat(f.fileno())
+      mvl_key = (
+        os.path.abspath(infile_path), stat.st_size, stat.st_mtime_ns
+      )
+      entries = mvl_cache.get(mvl_key)
+    if entries is None:
+      with stage('parse') as counts:
+        entries = process_mvl_data(f)
+        counts['bytes_in'] = f.tell()
+      if mvl_cache is not None:
+        mvl_cache[mvl_key] = entries
+    if wanted:
+      entries = [
+        entry for entry in entries
+        if wanted(os.path.join(basename, entry['name']))
+      ]
+      if not entries:
+        return iter(())
+    atlas = load_atlas(
+      atlas_cache, img_path, partial(open_atlas, img_path), engine
+    )
+    with stage('plan'):
+      plans = compile_mvl_plans(entries, *get_atlas_size(atlas))
+    if plans_callback:
+      plans_callback(plans, img_path, get_atlas_size(atlas), basename)
+  elif magic[:1] == b'{':
+    with stage('parse') as counts:
+      dicing = json.load(f)
+      counts['bytes_in'] = f.tell()
+    if not 'mvl_plans' in dicing:
+      return iter_undice_json(
+        dicing, os.path.dirname(infile_path), engine, atlas_cache,
+        wanted=wanted, band_height=band_height, renders=renders,
+        defer=defer, dir_images=dir_images
+      )
+    plans, img_path, atlas_size, basename = load_mvl_plans(dicing)
+    if wanted:
+      plans = [
+        plan for plan in plans
+        if wanted(os.path.join(basename, plan['name']))
+      ]
+      if not plans:
+        return iter(())
+    atlas = load_atlas(
+      atlas_cache, img_path, partial(open_atlas, img_path), engine
+    )
+    assert atlas_size == get_atlas_size(atlas), \
+      f'{img_path} no longer {atlas_size} as when plans were saved!'
+  else:
+    return None
+  return _iter_prefixed(
+    basename, iter_undice_mvl_plans(
+      atlas, plans, engine, band_height, renders, img_path, defer
+    )
+  )
+
+def _iter_undice_dicings(dicings, textures, *args):
+  for dicing in dicings:
+    yield from iter_undice_json(dicing, textures, *args)
+
+def _iter_prefixed(prefix, sprites):
+  for name, im in sprites:
+    if isinstance(im, SpriteAlias):
+      im = SpriteAlias(os.path.join(prefix, im.name))
+    yield os.path.join(prefix, name), im
+    del im # else kept while the next sprite is made
+
 def produce_undiced(
-  infile_path, outfold='out/', verbose=False, use_unitypack=False
+  infile_path, outfold='out/', verbose=False, use_unitypack=False,
+  engine='numpy', atlas_cache=None, save_plans=False, writer=None,
+  wanted=None, band_height=None, dedupe=False, mvl_cache=None,
+  dir_images=None
 ):
-  names = list(); ims = list()
+  # returns paths of saved files, or None if infile isn't MVL/JSON/bundle;
+  # save_plans also saves MVL paste plans to "<basename>.mvlplan.json";
+  # plans aren't saved with wanted, as they'd lack the sprites left out;
+  # wanted and band_height are as for iter_undiced; dedupe saves sprites
+  # rendering the same once, hard-linking the rest to them; mvl_cache and
+  # dir_images are as for iter_undiced; each sprite is handed to writer (a
+  # PNGWriter, or ProcessWriter, which gets DeferredSprites) and let go of
+  # before the next one is made, and all are written by the time this
+  # returns; if it fails, what it saved so far is removed again
+  saved = list(); seen = set()
+  # name: final_name of each sprite so far, and (final_name of the sprite
+  # aliased, final_name) to link once that's written
+  final_names = dict(); links = list()
+  if writer is None:
+    with_writer = PNGWriter()
+    try:
+      return produce_undiced(
+        infile_path, outfold, verbose, use_unitypack, engine, atlas_cache,
+        save_plans, with_writer, wanted, band_height, dedupe, mvl_cache,
+        dir_images
+      )
+    finally:
+      with_writer.close()
+
+  def plans_callback(plans, img_path, atlas_size, basename):
+    os.makedirs(outfold, exist_ok=True)
+    plans_path = get_final_name(outfold, basename, '.mvlplan.json')
+    save_mvl_plans(plans_path, plans, img_path, atlas_size, basename)
+    saved.append(plans_path)
+
+  undice_profile.set_file(infile_path)
   with open(infile_path, 'rb') as f:
     if verbose:
       print('Undicing:', infile_path)
-    magic = f.read(8); f.seek(0)
-    if magic == b'UnityFS\x00':
-      if unitypack_in_vogue == 'y' and use_unitypack:
-        dicings, textures = get_dicentex_from_assetbundle(f)
-        for dicing in dicings:
-          name, im = undice_json(dicing, textures)
-          names.extend(name); ims.extend(im)
-    elif magic[:4] == b'MVL1':
-      basename = os.path.splitext(os.path.basename(infile_path))[0]
-      if basename[-1] == '_':
-        basename = basename[:-1]
-      img_path = get_jpg_or_png(os.path.dirname(infile_path), basename)
-      names, ims = undice_mvl(Image.open(img_path), f)
-      outfold = os.path.join(outfold, basename)
-    elif magic[0] == 123: # i.e. starts with '{'
-      dicing = json.load(f)
-      names, ims = undice_json(dicing, os.path.dirname(infile_path))
-    elif verbose:
-      print(infile_path, 'not valid MVL/JSON/assetbundle!')
-    assert len(set(names)) == len(ims)
-    for name, im in zip(names, ims):
-      os.makedirs(os.path.dirname(os.path.join(outfold, name)), exist_ok=True)
-      if os.path.isfile(os.path.join(outfold, name + '.png')):
-        n = 1
-        while os.path.isfile(os.path.join(outfold, name + f' ({n}).png')):
-          n += 1
-        final_name = os.path.join(outfold, name + f' ({n}).png')
-      else:
-        final_name = os.path.join(outfold, name + '.png')
-      im.save(final_name, optimize=True)
+    sprites = iter_undiced(
+      f, infile_path, engine, atlas_cache, use_unitypack,
+      plans_callback if save_plans and not wanted else None, wanted,
+      band_height, dict() if dedupe else None, writer.deferred, mvl_cache,
+      dir_images
+    )
+    if sprites is None:
       if verbose:
-        print(final_name, 'saved!')
+        print(infile_path, 'not valid MVL/JSON/assetbundle!')
+      return None
+    try:
+      for name, im in sprites:
+        assert not name in seen, f'{infile_path} has more than one {name}!'
+        seen.add(name)
+        os.makedirs(
+          os.path.dirname(os.path.join(outfold, name)), exist_ok=True
+        )
+        final_name = writer.get_final_name(outfold, name)
+        if isinstance(im, SpriteAlias):
+          links.append((final_names[im.name], final_name))
+        else:
+          writer.submit(im, final_name)
+        del im
+        final_names[name] = final_name; saved.append(final_name)
+      writer.flush()
+      with stage('link'):
+        for target, final_name in links:
+          link_or_copy(target, final_name)
+    except BaseException:
+      # nothing of this file's may still be writing once it's failed, nor be
+      # left behind, so a rerun gets the same names
+      writer.flush(ignore_errors=True)
+      writer.discard(saved)
+      raise
+  if verbose:
+    for final_name in saved:
+      print(final_name, 'saved!')
+  return saved
 
-def undice_json(dicing, textures):
+def undice_json(
+  dicing, textures, engine='numpy', atlas_cache=None, source=None,
+  wanted=None
+):
   names = list(); ims = list()
+  for name, im in iter_undice_json(
+    dicing, textures, engine, atlas_cache, source, wanted
+  ):
+    names.append(name); ims.append(im)
+  return names, ims
+
+def iter_undice_json(
+  dicing, textures, engine='numpy', atlas_cache=None, source=None,
+  wanted=None, band_height=None, renders=None, defer=False, dir_images=None
+):
+  # textures dict values may also be callables returning the PILimg; source
+  # names where a textures dict came from, letting its atlases go in a shared
+  # atlas_cache (otherwise they're only reused within this call); wanted
+  # leaves out sprites whose name it's false for, before their atlas loads;
+  # band_height gives BandedSprites instead of PILimgs, numpy engine only;
+  # renders, defer and dir_images are as for iter_undiced
+  img_paths = dict()
+  if atlas_cache is None or (type(textures) == dict and source is None):
+    atlas_cache = AtlasCache()
   assert dicing['m_Enabled'] == 1
   cellSize = dicing['cellSize']; padding = dicing['padding']
   for textureData in dicing['textureDataList']:
+    if wanted and not wanted(textureData['name']):
+      continue
     texturename = textureData['atlasName']
     if type(textures) == str:
-      img_path = get_jpg_or_png(textures, texturename)
-      baseTexture = Image.open(img_path)
+      if not texturename in img_paths:
+        img_paths[texturename] = get_jpg_or_png(
+          textures, texturename, dir_images
+        )
+      key = img_paths[texturename]; loader = partial(open_atlas, key)
     elif type(textures) == dict:
-      baseTexture = textures[texturename]
+      key = (source, texturename); texture = textures[texturename]
+      loader = texture if callable(texture) else lambda: texture
     else:
       raise TypeError('arg "textures" must be str of folder or dict of PILimg')
-    name, im = undice_texture_data(baseTexture, textureData, cellSize, padding)
-    names.append(name); ims.append(im)
-  return names, ims
+    alias = check_rendered(
+      renders, textureData['name'], key, cellSize, padding,
+      textureData['width'], textureData['height'],
+      list(textureData['cellIndexList'])
+    )
+    if alias:
+      yield textureData['name'], alias
+      continue
+    baseTexture = load_atlas(atlas_cache, key, loader, engine)
+    if band_height:
+      yield textureData['name'], BandedSprite(
+        (textureData['width'], textureData['height']), band_height, partial(
+          undice_texture_data_band, baseTexture, textureData, cellSize,
+          padding
+        )
+      )
+      continue
+    if defer:
+      yield textureData['name'], DeferredSprite(
+        (textureData['width'], textureData['height']), partial(
+          undice_texture_data_np, baseTexture, textureData, cellSize, padding
+        )
+      )
+      continue
+    with stage('reconstruct') as counts:
+      if engine == 'numpy':
+        sprite = undice_texture_data_np(
+          baseTexture, textureData, cellSize, padding
+        )
+      else:
+        sprite = undice_texture_data(
+          baseTexture, textureData, cellSize, padding
+        )
+      counts['pixels'] = textureData['width'] * textureData['height']
+    yield sprite
+    del sprite # else kept while the next sprite is made
 
 def undice_texture_data(PILImage, textureData, cellSize=64, padding=3):
   assert PILImage.size[0] % cellSize == 0 and PILImage.size[1] % cellSize == 0
@@ -196,125 +949,1105 @@ def undice_texture_data(PILImage, textureData, cellSize=64, padding=3):
     newTexture.paste(block, (x2, y2))
   return textureData['name'], newTexture
 
-def _assert_makes_rect(a, b, c, d, basew, baseh):
-  assert (
-    a[0] == c[0] and a[3] == c[3] and b[0] == d[0] and b[3] == d[3] and
-    a[1] == b[1] and a[4] == b[4] and c[1] == d[1] and c[4] == d[4]
-  ), 'Coordinates don\'t make rect:\n' + "\n".join(currbank[a:d])
-  assert (
-    round(b[0] - a[0]) == round(b[3] * basew - a[3] * basew)
-  ) and (
-    round(c[1] - a[1]) == round(c[4] * baseh - a[4] * baseh)
-  ), 'Coordinates don\'t make same rect:\n' + "\n".join(currbank[a:d+1])
+def get_atlas_array(PILImage):
+  # same conversion paste() applies when blocks aren't already RGBA
+  return np.asarray(PILImage.convert('RGBA'))
 
-def process_mvl_data(mvl_fobj):
-  magic = mvl_fobj.read(4); mvl_fname = mvl_fobj.name
-  assert magic == b'MVL1', f'{mvl_fname} incorrect magic: {magic}'
-  entrycount = unpack('<i', mvl_fobj.read(4))[0]
-  assert mvl_fobj.read(24) == b'\x00\x10' + 22 * b'\x00', \
+def _get_dicing_blocks(atlas, textureData, cellSize, padding):
+  # (blocks, rows, cols, outside): blocks is a (rows, cols, pasteSize,
+  # pasteSize, 4) view of the atlas' blocks, and blocks[rows, cols] are the
+  # sprite's new blocks, (newBlocksDown, newBlocksAcross) of them from the
+  # top left; outside is None, or if any cell numbers are past the atlas, a
+  # mask of those new blocks, which crop() would have come out blank (their
+  # rows and cols point at block 0 instead)
+  baseh, basew = atlas.shape[:2]
+  assert basew % cellSize == 0 and baseh % cellSize == 0
+  pasteSize = cellSize - 2*padding
+  newBlocksAcross = ceil(textureData['width'] / pasteSize)
+  newBlocksDown = ceil(textureData['height'] / pasteSize)
+  assert newBlocksAcross * newBlocksDown == len(textureData['cellIndexList'])
+  baseBlocksAcross = basew // cellSize; baseBlocksDown = baseh // cellSize
+  # (rows, cols, pasteSize, pasteSize, 4) view of the atlas' blocks, no copy
+  blocks = atlas.reshape(
+    baseBlocksDown, cellSize, baseBlocksAcross, cellSize, 4
+  ).swapaxes(1, 2)[
+    :, :, padding:cellSize-padding, padding:cellSize-padding
+  ]
+  # cell numbers count block rows from the bottom of the atlas, and new
+  # blocks are laid out from the bottom of the sprite as well
+  cells = np.asarray(textureData['cellIndexList'], dtype=np.intp).reshape(
+    newBlocksDown, newBlocksAcross
+  )[::-1]
+  outside = (cells < 0) | (cells >= baseBlocksAcross * baseBlocksDown)
+  if outside.any():
+    cells = np.where(outside, 0, cells)
+  else:
+    outside = None
+  return (
+    blocks, baseBlocksDown - 1 - cells // baseBlocksAcross,
+    cells % baseBlocksAcross, outside
+  )
+
+def undice_texture_data_np(atlas, textureData, cellSize=64, padding=3):
+  # atlas is the (height, width, 4) array from get_atlas_array; gives the
+  # same image as undice_texture_data with one gather instead of a
+  # crop + paste per cell
+  blocks, rows, cols, outside = _get_dicing_blocks(
+    atlas, textureData, cellSize, padding
+  )
+  if outside is not None:
+    # cells past the atlas come out blank from crop(); leave those to PIL
+    return undice_texture_data(
+      Image.fromarray(atlas, 'RGBA'), textureData, cellSize, padding
+    )
+  pasteSize = blocks.shape[2]; newBlocksDown = len(rows)
+  newTexture = blocks[rows, cols].swapaxes(1, 2).reshape(
+    newBlocksDown * pasteSize, -1, 4
+  )[newBlocksDown * pasteSize - textureData['height']:, :textureData['width']]
+  return textureData['name'], Image.fromarray(
+    np.ascontiguousarray(newTexture), 'RGBA'
+  )
+
+def undice_texture_data_band(atlas, textureData, cellSize, padding, y0, y1):
+  # rows y0 to y1 of undice_texture_data_np's image, gathering only the
+  # block rows they cross; cells past the atlas come out blank, as crop()
+  # pads them
+  blocks, rows, cols, outside = _get_dicing_blocks(
+    atlas, textureData, cellSize, padding
+  )
+  pasteSize = blocks.shape[2]
+  # the top block row is cut short when height isn't a multiple of pasteSize
+  cut = len(rows) * pasteSize - textureData['height']
+  top = (y0 + cut) // pasteSize; bottom = -(-(y1 + cut) // pasteSize)
+  band = blocks[rows[top:bottom], cols[top:bottom]]
+  if outside is not None:
+    band[outside[top:bottom]] = 0
+  band = band.swapaxes(1, 2).reshape((bottom - top) * pasteSize, -1, 4)
+  offset = cut - top * pasteSize
+  return band[y0 + offset:y1 + offset, :textureData['width']]
+
+def _assert_makes_rects(quads, basew, baseh, name):
+  # quads is (n, 4, 5) array of coordinates a, b, c, d (top left, top right,
+  # bottom left, bottom right) making up each rect; all checked at once
+  a, b, c, d = quads[:, 0], quads[:, 1], quads[:, 2], quads[:, 3]
+  bad = ~(
+    (a[:, 0] == c[:, 0]) & (a[:, 3] == c[:, 3]) &
+    (b[:, 0] == d[:, 0]) & (b[:, 3] == d[:, 3]) &
+    (a[:, 1] == b[:, 1]) & (a[:, 4] == b[:, 4]) &
+    (c[:, 1] == d[:, 1]) & (c[:, 4] == d[:, 4])
+  )
+  assert not bad.any(), f'Image {name} coordinates don\'t make rect:\n' + \
+    str(quads[np.argmax(bad)])
+  bad = (
+    np.round(b[:, 0] - a[:, 0]) != np.round(b[:, 3] * basew - a[:, 3] * basew)
+  ) | (
+    np.round(c[:, 1] - a[:, 1]) != np.round(c[:, 4] * baseh - a[:, 4] * baseh)
+  )
+  assert not bad.any(), \
+    f'Image {name} coordinates don\'t make same rect:\n' + \
+    str(quads[np.argmax(bad)])
+
+# '<' in the formats is for little-endian; unknown if game source file will
+# change endianness if the machine's endianness changes (only worked with
+# Memories Off -Innocent Fille- assets)
+mvl_entry_dtype = np.dtype([
+  ('width', '<i4'), ('height', '<i4'), ('unk1', 'V8'),
+  ('bank_count', '<i4'), ('bank_address', '<i4'), # bank entry count, address
+  ('entrylen', '<i4'), ('address', '<i4'), ('name', 'V32')
+])
+
+def _map_mvl(mvl_fobj):
+  try:
+    return mmap.mmap(mvl_fobj.fileno(), 0, access=mmap.ACCESS_READ)
+  except (AttributeError, OSError, ValueError): # not a plain (non-empty) file
+    mvl_fobj.seek(0)
+    return mvl_fobj.read()
+
+def _close_map(buf):
+  if isinstance(buf, mmap.mmap):
+    try:
+      buf.close()
+    except BufferError: # views still held by a failed parse's traceback
+      pass
+
+def _parse_mvl_entry_table(buf, mvl_fname):
+  # checks header and returns entry table as mvl_entry_dtype array
+  assert buf[:4] == b'MVL1', f'{mvl_fname} incorrect magic: {bytes(buf[:4])}'
+  entrycount = unpack('<i', buf[4:8])[0]
+  assert buf[8:32] == b'\x00\x10' + 22 * b'\x00', \
     f'{mvl_fname} begin 1 part inconsistent!'
-  assert mvl_fobj.read(10) == b'XFYF0FUFVF', \
+  assert buf[32:42] == b'XFYF0FUFVF', \
     f'{mvl_fname} XFYF part inconsistent!'
-  assert mvl_fobj.read(54) == 54 * b'\x00', \
+  assert buf[42:96] == 54 * b'\x00', \
     f'{mvl_fname} begin part 3 inconsistent!'
-  entries = []; banks = dict()
-  for x in range(entrycount):
-    # '<' in the unpack arg is for little-endian; unknown if game source file
-    # will change endianness if the machine's endianness changes
-    # (only worked with Memories Off -Innocent Fille- assets)
-    entry = dict()
-    entry['width'], entry['height'] = unpack('<2i', mvl_fobj.read(8))
-    unk1 = mvl_fobj.read(8)
-    assert unk1 == b'\x04\x01\x00\x01\x00\x00\x00\x00', \
-      f'{mvl_fname} entry {x} unk1 inconsistent: {unk1}'
-    # bank entry count, bank start address
-    bank = unpack('<2i', mvl_fobj.read(8)) # count + address
-    entry['bank_address'] = bank[1]
-    entry['entrylen'], entry['address'] = unpack('<2i', mvl_fobj.read(8))
-    entry['name'] = mvl_fobj.read(32).strip(b'\x00').decode()
-    assert entry['entrylen'] % 6 == 0, \
-      f'Image {entry["name"]} entrylen not divisible by six!'
-    if not bank[1] in banks:
-      banks[bank[1]] = bank[0]
+  table = np.frombuffer(buf, mvl_entry_dtype, entrycount, 96)
+  bad = table['unk1'] != np.void(b'\x04\x01\x00\x01\x00\x00\x00\x00')
+  if bad.any():
+    x = np.argmax(bad)
+    raise AssertionError(
+      f'{mvl_fname} entry {x} unk1 inconsistent: {bytes(table["unk1"][x])}'
+    )
+  return table
+
+def _get_mvl_names(table):
+  return [bytes(name).strip(b'\x00').decode() for name in table['name']]
+
+class MVLEntry(dict):
+  # entry of process_mvl_data; 'coors', the quads as nested lists as they
+  # used to be parsed into, is only made if asked for
+  def __missing__(self, key):
+    if key == 'coors':
+      return self['quads'].tolist()
+    raise KeyError(key)
+
+def process_mvl_data(mvl_fobj):
+  # whole file is mapped and decoded through array views of it, with the same
+  # consistency checks as reading it bit by bit, done over whole tables; the
+  # map is closed once everything kept is copied out of it
+  buf = _map_mvl(mvl_fobj)
+  try:
+    return _process_mvl_buf(buf, mvl_fobj)
+  finally:
+    _close_map(buf)
+
+def _process_mvl_buf(buf, mvl_fobj):
+  mvl_fname = mvl_fobj.name
+  table = _parse_mvl_entry_table(buf, mvl_fname)
+  names = _get_mvl_names(table)
+  bad = table['entrylen'] % 6 != 0
+  if bad.any():
+    raise AssertionError(
+      f'Image {names[np.argmax(bad)]} entrylen not divisible by six!'
+    )
+  banks = dict()
+  for x, (bank_count, bank_address) in enumerate(
+    table[['bank_count', 'bank_address']].tolist()
+  ):
+    if not bank_address in banks:
+      banks[bank_address] = bank_count
     else:
-      assert banks[bank[1]] == bank[0], \
-        f'Image {entry["name"]} has bank address that starts same but has ' \
-        f'different entry count! Expected len & add: {bank}, actual len: ' \
-        f'{banks[bank[1]]}'
-    entries.append(entry)
+      assert banks[bank_address] == bank_count, \
+        f'Image {names[x]} has bank address that starts same but has ' \
+        f'different entry count! Expected len & add: ' \
+        f'{(bank_count, bank_address)}, actual len: {banks[bank_address]}'
+  position = 96 + table.nbytes
   for _ in range(len(banks)):
-    bankaddress = mvl_fobj.tell()
+    bankaddress = position
     assert bankaddress in banks, f'{mvl_fname} position {bankaddress} ' \
       f'slipped from possible bank start address(es) {banks.keys()}'
-    bankcount = banks[bankaddress]
-    banks[bankaddress] = list()
-    for y in range(bankcount):
-      # for each coordinates: 1st and 2nd are x and y for paste, 3rd is 0, and
-      # 4th and 5th are %x and %y for cut
-      corresp_coor = unpack('<5f', mvl_fobj.read(20))
-      assert corresp_coor[2] == 0, \
-        f'{mvl_fname} bank had 3rd item of coor entry not 0: {corresp_coor}' \
-        f' (at {mvl_fobj.tell()})'
-      banks[bankaddress].append(corresp_coor)
-  for entry in entries:
-    currbank = banks[entry['bank_address']]
-    assert entry['address'] == mvl_fobj.tell(), \
-      f'Address mismatch: currently at {mvl_fobj.tell()}, expected to be' \
-      f' at {entry["address"]}! (Entry: {entry["name"]})'
-    entry['coors'] = list()
-    for x in range(entry['entrylen'] // 6):
-      a, b, c = unpack('<3h', mvl_fobj.read(6))
-      assert c - b == 1 and b - a == 1 and \
-        b == unpack('<h', mvl_fobj.read(2))[0], \
-        f"Image {entry['name']} {x}th set of 6 isn't 012132 pattern!"
-      d = unpack('<h', mvl_fobj.read(2))[0]
-      assert d - c == 1 and c == unpack('<h', mvl_fobj.read(2))[0], \
-        f"Image {entry['name']} {x}th set of 6 isn't 012132 pattern!"
-      # print(len(currbank), a, b, c, d)
-      a = currbank[a]; b = currbank[b]; c = currbank[c]; d = currbank[d]
-      entry['coors'].append((a, b, c, d))
+    # for each coordinates: 1st and 2nd are x and y for paste, 3rd is 0, and
+    # 4th and 5th are %x and %y for cut
+    bank = np.frombuffer(
+      buf, '<f4', 5 * banks[bankaddress], bankaddress
+    ).reshape(-1, 5)
+    bad = bank[:, 2] != 0
+    if bad.any():
+      y = np.argmax(bad)
+      raise AssertionError(
+        f'{mvl_fname} bank had 3rd item of coor entry not 0: '
+        f'{tuple(bank[y].tolist())} (at {bankaddress + 20 * (y + 1)})'
+      )
+    banks[bankaddress] = bank.astype(np.float64)
+    position += bank.nbytes
+  # entries' index sets follow one another right after the banks
+  expected = position + 2 * np.concatenate(
+    ([0], np.cumsum(table['entrylen'][:-1], dtype=np.int64))
+  )
+  bad = table['address'] != expected[:len(table)]
+  if bad.any():
+    x = np.argmax(bad)
+    raise AssertionError(
+      f'Address mismatch: currently at {expected[x]}, expected to be at '
+      f'{table["address"][x]}! (Entry: {names[x]})'
+    )
+  indices = np.frombuffer(
+    buf, '<i2', int(table['entrylen'].sum()), position
+  ).reshape(-1, 6).astype(np.intp)
+  a, b, c, b2, d, c2 = indices.T
+  bad = (c - b != 1) | (b - a != 1) | (b != b2) | (d - c != 1) | (c != c2)
+  if bad.any():
+    quad = np.argmax(bad)
+    x = np.searchsorted(np.cumsum(table['entrylen'] // 6), quad, 'right')
+    raise AssertionError(
+      f"Image {names[x]} {quad - (expected[x] - position) // 12}th set of 6 "
+      "isn't 012132 pattern!"
+    )
+  entries = []; start = 0
+  for x, (width, height, bank_address, entrylen, address) in enumerate(
+    table[['width', 'height', 'bank_address', 'entrylen', 'address']].tolist()
+  ):
+    stop = start + entrylen // 6
+    entry = MVLEntry(
+      width=width, height=height, bank_address=bank_address,
+      entrylen=entrylen, address=address, name=names[x],
+      # (quads, 4, 5) coordinates for a, b, c, d of each quad
+      quads=banks[bank_address][indices[start:stop][:, [0, 1, 2, 4]]]
+    )
+    entries.append(entry); start = stop
+  mvl_fobj.seek(position + 2 * start)
   return entries #, banks
 
-def undice_mvl(PILimage, mvl_fobj):
+def compile_mvl_plan(entry, basew, baseh):
+  # paste plan for an entry from process_mvl_data, against a basew x baseh
+  # atlas: (quads, 6) int32 array of src_x0, src_y0, src_x1, src_y1, dst_x,
+  # dst_y, so rendering needs no more float maths or checks
+  quads = entry['quads']
+  _assert_makes_rects(quads, basew, baseh, entry['name'])
+  adjust = entry['width'] // 2 # i.e. center is middle top
+  plan = np.empty((len(quads), 6), dtype=np.int32)
+  # np.round rounds half to even, same as round()
+  plan[:, 0] = np.round(quads[:, 0, 3] * basew)
+  plan[:, 1] = np.round(quads[:, 0, 4] * baseh)
+  plan[:, 2] = np.round(quads[:, 3, 3] * basew)
+  plan[:, 3] = np.round(quads[:, 3, 4] * baseh)
+  plan[:, 4] = np.round(quads[:, 0, 0]) + adjust
+  plan[:, 5] = np.round(quads[:, 0, 1])
+  return {
+    'name': entry['name'], 'width': entry['width'], 'height': entry['height'],
+    'plan': plan
+  }
+
+def compile_mvl_plans(entries, basew, baseh):
+  return [compile_mvl_plan(entry, basew, baseh) for entry in entries]
+
+def save_mvl_plans(path, plans, atlas_path, atlas_size, basename):
+  # lets the MVL be rendered again (e.g. at other PNG settings) without
+  # parsing it, by passing the saved file as input in place of the MVL
+  with open(path, 'w') as f:
+    json.dump({
+      'mvl_plans': [
+        dict(plan, plan=plan['plan'].tolist()) for plan in plans
+      ],
+      'atlas': os.path.abspath(atlas_path),
+      'atlas_size': [int(n) for n in atlas_size], 'basename': basename
+    }, f)
+
+def load_mvl_plans(plans_json):
+  # plans_json is the json.load()ed plan file; returns plans, atlas path,
+  # atlas size and basename as given to save_mvl_plans
+  plans = [
+    dict(plan, plan=np.array(plan['plan'], dtype=np.int32).reshape(-1, 6))
+    for plan in plans_json['mvl_plans']
+  ]
+  return (
+    plans, plans_json['atlas'], tuple(plans_json['atlas_size']),
+    plans_json['basename']
+  )
+
+def undice_mvl(atlas, mvl_fobj, engine=None):
   names = list(); ims = list()
-  entries = process_mvl_data(mvl_fobj)
-  for entry in entries:
-    name, im = undice_mvl_data(PILimage, entry)
+  for name, im in iter_undice_mvl(atlas, mvl_fobj, engine):
     names.append(name); ims.append(im)
   return names, ims
 
+def iter_undice_mvl(atlas, mvl_fobj, engine=None):
+  # atlas is a PILimage or an array from get_atlas_array; engine defaults to
+  # the one working with what it is, and a PILimage is converted for numpy
+  if engine is None:
+    engine = 'numpy' if isinstance(atlas, np.ndarray) else 'pil'
+  if engine == 'numpy' and not isinstance(atlas, np.ndarray):
+    atlas = get_atlas_array(atlas)
+  plans = compile_mvl_plans(
+    process_mvl_data(mvl_fobj), *get_atlas_size(atlas)
+  )
+  return iter_undice_mvl_plans(atlas, plans, engine)
+
+def iter_undice_mvl_plans(
+  atlas, plans, engine='numpy', band_height=None, renders=None, source=None,
+  defer=False
+):
+  # band_height gives BandedSprites instead of PILimgs, numpy engine only;
+  # renders and defer are as for iter_undiced, source naming the atlas in
+  # renders' keys
+  for plan in plans:
+    alias = check_rendered(
+      renders, plan['name'], source, plan['width'], plan['height'],
+      data=plan['plan'].tobytes()
+    )
+    if alias:
+      yield plan['name'], alias
+      continue
+    if band_height:
+      yield plan['name'], BandedSprite(
+        (plan['width'], plan['height']), band_height,
+        partial(undice_mvl_plan_band, atlas, plan)
+      )
+      continue
+    if defer:
+      yield plan['name'], DeferredSprite(
+        (plan['width'], plan['height']),
+        partial(undice_mvl_plan_np, atlas, plan)
+      )
+      continue
+    with stage('reconstruct') as counts:
+      sprite = undice_mvl_plan(atlas, plan, engine)
+      counts['pixels'] = plan['width'] * plan['height']
+    yield sprite
+    del sprite # else kept while the next sprite is made
+
 def undice_mvl_data(PILimage, entry):
-  basew, baseh = PILimage.size
-  im = Image.new('RGBA', (entry['width'], entry['height']))
-  adjust = entry['width'] // 2 # i.e. center is middle top
-  for coor in entry['coors']:
-    a, b, c, d = coor
-    _assert_makes_rect(a, b, c, d, basew, baseh)
-    im.paste(
-      PILimage.crop((
-        round(a[3] * basew), round(a[4] * baseh),
-        round(d[3] * basew), round(d[4] * baseh)
-      )),
-      (round(a[0]) + adjust, round(a[1]))
-    )
-  return entry['name'], im
+  return undice_mvl_plan(PILimage, compile_mvl_plan(entry, *PILimage.size))
+
+def undice_mvl_plan(atlas, plan, engine='pil'):
+  if engine == 'numpy':
+    return undice_mvl_plan_np(atlas, plan)
+  im = Image.new('RGBA', (plan['width'], plan['height']))
+  for src_x0, src_y0, src_x1, src_y1, dst_x, dst_y in plan['plan'].tolist():
+    im.paste(atlas.crop((src_x0, src_y0, src_x1, src_y1)), (dst_x, dst_y))
+  return plan['name'], im
+
+def undice_mvl_plan_np(atlas, plan):
+  # same as undice_mvl_plan but with slice copies out of the atlas array
+  baseh, basew = atlas.shape[:2]
+  width, height = plan['width'], plan['height']
+  quads = plan['plan']
+  if len(quads) and (
+    (quads[:, :2] < 0).any() or (quads[:, 2] > basew).any() or
+    (quads[:, 3] > baseh).any()
+  ):
+    # crop() zero-pads parts outside of the atlas; leave those to PIL
+    return undice_mvl_plan(Image.fromarray(atlas, 'RGBA'), plan)
+  im = np.zeros((height, width, 4), dtype=np.uint8)
+  for src_x0, src_y0, src_x1, src_y1, dst_x, dst_y in quads.tolist():
+    # clip to the canvas like paste() does
+    x0 = max(dst_x, 0); y0 = max(dst_y, 0)
+    x1 = min(dst_x + src_x1 - src_x0, width)
+    y1 = min(dst_y + src_y1 - src_y0, height)
+    if x0 < x1 and y0 < y1:
+      im[y0:y1, x0:x1] = atlas[
+        src_y0 + y0 - dst_y:src_y0 + y1 - dst_y,
+        src_x0 + x0 - dst_x:src_x0 + x1 - dst_x
+      ]
+  return plan['name'], Image.fromarray(im, 'RGBA')
+
+def undice_mvl_plan_band(atlas, plan, y0, y1):
+  # rows y0 to y1 of undice_mvl_plan's image out of the atlas array, pasting
+  # only the quads that reach into them; parts of quads outside the atlas
+  # come out blank, as crop() pads them
+  baseh, basew = atlas.shape[:2]
+  width = plan['width']; quads = plan['plan']
+  tops = quads[:, 5]; bottoms = tops + quads[:, 3] - quads[:, 1]
+  band = np.zeros((y1 - y0, width, 4), dtype=np.uint8)
+  for src_x0, src_y0, src_x1, src_y1, dst_x, dst_y in quads[
+    (tops < y1) & (bottoms > y0)
+  ].tolist():
+    # clip to the band like paste() does to the canvas
+    x0 = max(dst_x, 0); x1 = min(dst_x + src_x1 - src_x0, width)
+    top = max(dst_y, y0); bottom = min(dst_y + src_y1 - src_y0, y1)
+    if x0 >= x1 or top >= bottom:
+      continue
+    # then the source to the atlas, blanking whatever that cuts off
+    dx = src_x0 - dst_x; dy = src_y0 - dst_y
+    sx0 = max(x0 + dx, 0); sx1 = min(x1 + dx, basew)
+    sy0 = max(top + dy, 0); sy1 = min(bottom + dy, baseh)
+    if (sx0, sx1, sy0, sy1) != (x0 + dx, x1 + dx, top + dy, bottom + dy):
+      band[top - y0:bottom - y0, x0:x1] = 0
+    if sx0 < sx1 and sy0 < sy1:
+      band[sy0 - dy - y0:sy1 - dy - y0, sx0 - dx:sx1 - dx] = \
+        atlas[sy0:sy1, sx0:sx1]
+  return band
+
+## sprite selection
+def get_sprite_index(f, infile_path, use_unitypack=False, dir_images=None):
+  # list of {'name', 'width', 'height', 'cells', 'atlas'} for each sprite in
+  # opened infile f, named as iter_undiced would (cells are quads for MVL),
+  # read from its metadata alone with no image decoded; None if f isn't
+  # MVL/JSON/bundle; dir_images is as for get_jpg_or_png
+  magic = f.read(8); f.seek(0)
+  if magic == b'UnityFS\x00':
+    dicings, textures = get_bundle_dicentex(f, use_unitypack)
+    return [sprite for dicing in dicings for sprite in _index_dicing(dicing)]
+  elif magic[:4] == b'MVL1':
+    basename = get_mvl_basename(infile_path)
+    img_path = get_jpg_or_png(
+      os.path.dirname(infile_path), basename, dir_images
+    )
+    buf = _map_mvl(f); table = None
+    try:
+      with stage('parse') as counts:
+        table = _parse_mvl_entry_table(buf, f.name)
+        counts['bytes_in'] = 96 + table.nbytes
+      return [{
+        'name': os.path.join(basename, name), 'width': width,
+        'height': height, 'cells': entrylen // 6, 'atlas': img_path
+      } for name, (width, height, entrylen) in zip(
+        _get_mvl_names(table), table[['width', 'height', 'entrylen']].tolist()
+      )]
+    finally:
+      table = None # a view of buf
+      _close_map(buf)
+  elif magic[:1] == b'{':
+    with stage('parse') as counts:
+      dicing = json.load(f)
+      counts['bytes_in'] = f.tell()
+    if not 'mvl_plans' in dicing:
+      return _index_dicing(dicing, os.path.dirname(infile_path), dir_images)
+    return [{
+      'name': os.path.join(dicing['basename'], plan['name']),
+      'width': plan['width'], 'height': plan['height'],
+      'cells': len(plan['plan']), 'atlas': dicing['atlas']
+    } for plan in dicing['mvl_plans']]
+  return None
+
+def _index_dicing(dicing, dirname=None, dir_images=None):
+  # atlases are named as in the dicing, or by path if found in dirname
+  img_paths = dict()
+  if dirname is not None:
+    for texturename in set(
+      textureData['atlasName'] for textureData in dicing['textureDataList']
+    ):
+      try:
+        img_paths[texturename] = get_jpg_or_png(
+          dirname, texturename, dir_images
+        )
+      except FileNotFoundError:
+        pass
+  return [{
+    'name': textureData['name'], 'width': textureData['width'],
+    'height': textureData['height'],
+    'cells': len(textureData['cellIndexList']),
+    'atlas': img_paths.get(textureData['atlasName'], textureData['atlasName'])
+  } for textureData in dicing['textureDataList']]
+
+def name_matches(patterns, name):
+  # whether name, or the last part of it, matches any of the fnmatch patterns
+  return any(
+    fnmatch(name, pattern) or fnmatch(os.path.basename(name), pattern)
+    for pattern in patterns
+  )
+
+def print_sprite_index(
+  infile_path, verbose=False, use_unitypack=False, wanted=None,
+  dir_images=None
+):
+  with open(infile_path, 'rb') as f:
+    index = get_sprite_index(f, infile_path, use_unitypack, dir_images)
+  if index is None:
+    if verbose:
+      print(infile_path, 'not valid MVL/JSON/assetbundle!')
+    return
+  if wanted:
+    index = [sprite for sprite in index if wanted(sprite['name'])]
+  print(f'{infile_path}: {len(index)} sprite(s)')
+  for sprite in index:
+    print(
+      f"  {sprite['name']}  {sprite['width']}x{sprite['height']}  "
+      f"{sprite['cells']} cells  {sprite['atlas']}"
+    )
+
+## incremental runs
+def get_undice_inputs(infile_path, dir_images=None):
+  # files that go into undicing infile_path, itself first; dir_images is as
+  # for get_jpg_or_png
+  inputs = [infile_path]
+  with open(infile_path, 'rb') as f:
+    magic = f.read(8); f.seek(0)
+    if magic[:4] == b'MVL1':
+      inputs.append(get_jpg_or_png(
+        os.path.dirname(infile_path), get_mvl_basename(infile_path),
+        dir_images
+      ))
+    elif magic[:1] == b'{':
+      dicing = json.load(f)
+      if 'mvl_plans' in dicing:
+        inputs.append(dicing['atlas'])
+      else:
+        for texturename in sorted(set(
+          textureData['atlasName'] for textureData in dicing['textureDataList']
+        )):
+          inputs.append(get_jpg_or_png(
+            os.path.dirname(infile_path), texturename, dir_images
+          ))
+  return inputs
+
+def get_file_digest(path):
+  digest = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for chunk in iter(partial(f.read, 2**20), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def get_input_digests(infile_path, digests=None, dir_images=None):
+  # abspath: [size, mtime_ns, sha1] of each file there going into undicing
+  # infile_path; files matching their entry in digests, a dict of the same,
+  # in size and mtime aren't read again, and the rest get entries there
+  if digests is None:
+    digests = dict()
+  inputs = dict()
+  for path in get_undice_inputs(infile_path, dir_images):
+    path = os.path.abspath(path)
+    try:
+      stat = os.stat(path)
+    except OSError:
+      continue
+    if path in digests and \
+      digests[path][:2] == [stat.st_size, stat.st_mtime_ns]:
+      inputs[path] = digests[path]
+    else:
+      inputs[path] = digests[path] = [
+        stat.st_size, stat.st_mtime_ns, get_file_digest(path)
+      ]
+  return inputs
+
+class Manifest:
+  # record kept in the output folder of which files were undiced there, the
+  # content hashes of everything that went into each, and what came out, so
+  # that reruns can skip files whose inputs haven't changed
+  fname = '.undice-manifest.json'
+
+  def __init__(self, outfold):
+    self.outfold = outfold; self.path = os.path.join(outfold, self.fname)
+    self.units = dict()
+    if os.path.isfile(self.path):
+      with open(self.path) as f:
+        self.units = json.load(f)['units']
+    # path: (size, mtime_ns, sha1) for files looked at this run
+    self.digests = dict()
+
+  def get_digest(self, path, known=None):
+    # known is a previous (size, mtime_ns, sha1) of path; files whose size
+    # and mtime still match it aren't read again
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return None
+    if not path in self.digests or \
+      self.digests[path][:2] != [stat.st_size, stat.st_mtime_ns]:
+      if known and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+        self.digests[path] = known
+      else:
+        self.digests[path] = [
+          stat.st_size, stat.st_mtime_ns, get_file_digest(path)
+        ]
+    return self.digests[path][2]
+
+  def is_current(self, infile_path):
+    unit = self.units.get(os.path.abspath(infile_path))
+    if unit is None:
+      return False
+    return all(
+      self.get_digest(path, known) == known[2]
+      for path, known in unit['inputs'].items()
+    ) and all(
+      os.path.isfile(os.path.join(self.outfold, output))
+      for output in unit['outputs']
+    )
+
+  def forget(self, infile_path):
+    # drops infile_path's previous outputs, so that undicing it again reuses
+    # their names instead of adding " (n)" copies
+    unit = self.units.pop(os.path.abspath(infile_path), None)
+    if unit:
+      for output in unit['outputs']:
+        if os.path.isfile(os.path.join(self.outfold, output)):
+          os.remove(os.path.join(self.outfold, output))
+
+  def record(self, infile_path, saved, inputs=None, dir_images=None):
+    # inputs is get_input_digests(infile_path) if already got, e.g. by the
+    # pool worker that undiced it
+    if inputs is None:
+      inputs = get_input_digests(infile_path, self.digests, dir_images)
+    else:
+      self.digests.update(inputs)
+    self.units[os.path.abspath(infile_path)] = {
+      'inputs': inputs,
+      'outputs': [os.path.relpath(path, self.outfold) for path in saved or ()]
+    }
+
+  def save(self):
+    os.makedirs(self.outfold, exist_ok=True)
+    with open(self.path + '.tmp', 'w') as f:
+      json.dump({'units': self.units}, f)
+    os.replace(self.path + '.tmp', self.path)
+
+def iter_outdated(infile_paths, manifest, force=False, verbose=False):
+  # leaves out files manifest says are unchanged, unless forced; the previous
+  # outputs of those kept stay till they're undiced again successfully (see
+  # settle_staged)
+  for infile_path in infile_paths:
+    if not force and manifest.is_current(infile_path):
+      if verbose:
+        print('Unchanged, skipping:', infile_path)
+      continue
+    yield infile_path
+
+## scanning
+# files with these extensions are atlases, never undiced themselves
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg')
+
+def classify_file(path, name):
+  # 'mvl', 'json', 'bundle', 'image' or None if it's none of those, going
+  # by the extension, and reading magic bytes only if that says nothing
+  ext = os.path.splitext(name)[1].lower()
+  if ext in IMAGE_EXTS:
+    return 'image'
+  if ext == '.mvl':
+    return 'mvl'
+  if ext == '.json':
+    return 'json'
+  try:
+    with open(path, 'rb') as f:
+      magic = f.read(8)
+  except OSError:
+    return None
+  if magic == b'UnityFS\x00':
+    return 'bundle'
+  if magic[:4] == b'MVL1':
+    return 'mvl'
+  if magic[:1] == b'{':
+    return 'json'
+  return None
+
+class ScanCache:
+  # folder listings from earlier scans, kept in the output folder, reused
+  # while the folder's mtime is unchanged, which it isn't once a file in it
+  # is added, removed or renamed (files rewritten in place keep the kind
+  # they were found to be)
+  fname = '.undice-scan.json'
+
+  def __init__(self, outfold=None):
+    self.path = outfold and os.path.join(outfold, self.fname)
+    self.dirs = dict(); self.changed = False
+    if self.path and os.path.isfile(self.path):
+      try:
+        with open(self.path) as f:
+          self.dirs = json.load(f)['dirs']
+      except (OSError, ValueError, KeyError): # unreadable, so scan afresh
+        pass
+
+  def save(self):
+    if not (self.path and self.changed):
+      return
+    os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+    with open(self.path + '.tmp', 'w') as f:
+      json.dump({'dirs': self.dirs}, f)
+    os.replace(self.path + '.tmp', self.path)
+
+def scan_dir(dirpath, cache=None):
+  # {'mtime_ns', 'dirs': [name, ...], 'inputs': [[name, kind], ...],
+  # 'images': [name, ...]} of dirpath, in listing order, from cache if it
+  # has it for the folder's current mtime; like os.walk(), folders that are
+  # symlinks aren't gone into
+  key = os.path.abspath(dirpath)
+  # statted before listing, so anything added meanwhile changes it again
+  mtime_ns = os.stat(dirpath).st_mtime_ns
+  listing = cache.dirs.get(key) if cache else None
+  if listing is not None and listing['mtime_ns'] == mtime_ns:
+    return listing
+  listing = {'mtime_ns': mtime_ns, 'dirs': [], 'inputs': [], 'images': []}
+  with os.scandir(dirpath) as entries:
+    for entry in entries:
+      try:
+        is_dir = entry.is_dir()
+      except OSError:
+        is_dir = False
+      if is_dir:
+        if not entry.is_symlink():
+          listing['dirs'].append(entry.name)
+        continue
+      kind = classify_file(entry.path, entry.name)
+      if kind == 'image':
+        listing['images'].append(entry.name)
+      elif kind:
+        listing['inputs'].append([entry.name, kind])
+  if cache is not None:
+    cache.dirs[key] = listing; cache.changed = True
+  return listing
+
+def scan_fpaths(fpaths, cache=None, dir_images=None):
+  # files in fpaths and the folders in it, but for the ones that can't be
+  # undiced, atlases included, listing each folder once (or not at all if
+  # cache has it unchanged); if given, dir_images, a dict, gets abspath of
+  # folder: set of its images' names for each, by the time its files come,
+  # for get_jpg_or_png and alike to look in during the same run; files given
+  # directly are kept
+  for discrete_path in fpaths:
+    if os.path.isfile(discrete_path):
+      yield discrete_path
+    elif os.path.isdir(discrete_path):
+      yield from _scan_tree(discrete_path, cache, dir_images)
+    else:
+      print(discrete_path, 'does not exist!')
+
+def _scan_tree(dirpath, cache, dir_images):
+  try:
+    listing = scan_dir(dirpath, cache)
+  except OSError: # as os.walk() skips folders it can't list
+    return
+  if dir_images is not None:
+    dir_images[os.path.abspath(dirpath)] = set(listing['images'])
+  for name, kind in listing['inputs']:
+    yield os.path.join(dirpath, name)
+  for name in listing['dirs']:
+    yield from _scan_tree(os.path.join(dirpath, name), cache, dir_images)
+
+def get_folder_images(dir_images, infile_path):
+  # just the part of dir_images for infile_path's folder, where its atlases
+  # are looked for, to send pool workers
+  if not dir_images:
+    return None
+  key = os.path.abspath(os.path.dirname(infile_path))
+  return {key: dir_images[key]} if key in dir_images else None
+
+## batch running
+def report_failure(failures, infile_path, error, verbose=False):
+  print('Failed:', infile_path)
+  print(error if verbose else error.strip().splitlines()[-1])
+  failures.append((infile_path, error))
+
+def settle_staged(
+  infile_path, staging, saved, outfold, manifest=None, verbose=False,
+  inputs=None
+):
+  # once infile_path was undiced into staging (saved being what
+  # produce_undiced returned), swaps its previous outputs in outfold, going
+  # by manifest, for the new ones, named as if saved straight there, and
+  # records them; returns their paths in outfold
+  if manifest:
+    manifest.forget(infile_path)
+  final_names = None
+  if saved is None:
+    if verbose:
+      print(infile_path, 'not valid MVL/JSON/assetbundle!')
+  else:
+    final_names = list()
+    for staged_name in saved:
+      name = os.path.relpath(staged_name, staging)
+      ext = '.mvlplan.json' if name.endswith('.mvlplan.json') else '.png'
+      name = name[:-len(ext)]
+      os.makedirs(
+        os.path.dirname(os.path.join(outfold, name)), exist_ok=True
+      )
+      final_name = get_final_name(outfold, name, ext)
+      os.replace(staged_name, final_name)
+      final_names.append(final_name)
+      if verbose:
+        print(final_name, 'saved!')
+  shutil.rmtree(staging, ignore_errors=True)
+  if manifest:
+    manifest.record(infile_path, final_names, inputs)
+  return final_names
+
+def produce_undiced_serial(
+  infile_paths, outfold='out/', verbose=False, atlas_cache=None,
+  writer=None, manifest=None, dir_images=None, **kwargs
+):
+  # produce_undiced on each file in turn here, into staging as
+  # produce_undiced_pool does, so a file failing leaves its previous outputs
+  # be, and is reported and gone past; returns the same failures
+  failures = list()
+  os.makedirs(outfold, exist_ok=True)
+  with make_staging_root(outfold) as staging_root:
+    for infile_path in infile_paths:
+      if verbose:
+        print('Undicing:', infile_path)
+      staging = tempfile.mkdtemp(dir=staging_root); inputs = None
+      try:
+        saved = produce_undiced(
+          infile_path, staging, False, atlas_cache=atlas_cache,
+          writer=writer, dir_images=dir_images, **kwargs
+        )
+        if manifest:
+          inputs = get_input_digests(
+            infile_path, manifest.digests, dir_images
+          )
+      except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        report_failure(
+          failures, infile_path, traceback.format_exc(), verbose
+        )
+        continue
+      settle_staged(
+        infile_path, staging, saved, outfold, manifest, verbose,
+        inputs
+      )
+  return failures
+
+worker_atlas_cache = None; worker_writer = None; worker_digests = None
+
+def _init_worker(atlas_cache_bytes, writer_args, profile):
+  global worker_atlas_cache, worker_writer, worker_digests
+  worker_atlas_cache = AtlasCache(atlas_cache_bytes)
+  worker_writer = PNGWriter(*writer_args)
+  worker_digests = dict()
+  if profile:
+    # forked workers start off with whatever the parent had timed so far
+    undice_profile.enable().reset()
+
+def _produce_undiced_staged(infile_path, staging_root, kwargs, digest=False):
+  # pool worker: saves into its own staging folder so that final names (and
+  # their " (n)" collision suffixes) can be settled in input order afterwards;
+  # with digest, also hashes the files that went in, for the manifest
+  staging = tempfile.mkdtemp(dir=staging_root)
+  inputs = None
+  try:
+    saved = produce_undiced(
+      infile_path, staging, False, atlas_cache=worker_atlas_cache,
+      writer=worker_writer, **kwargs
+    )
+    if digest:
+      inputs = get_input_digests(
+        infile_path, worker_digests, kwargs.get('dir_images')
+      )
+  except Exception:
+    shutil.rmtree(staging, ignore_errors=True)
+    return None, None, None, traceback.format_exc(), _get_worker_stats()
+  return staging, saved, inputs, None, _get_worker_stats()
+
+def make_staging_root(outfold):
+  # TemporaryDirectory for pool workers' staging folders: in the system temp
+  # folder if that's on outfold's filesystem, so staged files can still be
+  # moved into place, else in outfold, where any left by runs killed midway
+  # are removed first (runs into one outfold at a time being all that's
+  # supported)
+  temp = tempfile.gettempdir()
+  if os.stat(temp).st_dev == os.stat(outfold).st_dev:
+    return tempfile.TemporaryDirectory(prefix='.undice-', dir=temp)
+  for entry in os.scandir(outfold):
+    if entry.name.startswith('.undice-') and \
+      entry.is_dir(follow_symlinks=False):
+      shutil.rmtree(entry.path, ignore_errors=True)
+  return tempfile.TemporaryDirectory(prefix='.undice-', dir=outfold)
+
+def _get_worker_stats():
+  # (pid, atlas cache counters so far, profile since last call or None)
+  profile = None
+  if undice_profile.profiler:
+    profile = undice_profile.profiler.as_dict()
+    undice_profile.profiler.reset()
+  return os.getpid(), worker_atlas_cache.counters(), profile
+
+def _save_deferred(items):
+  # pool worker for ProcessWriter: renders and saves a chunk of its sprites,
+  # their atlases mapped from shared memory as the chunk was unpickled
+  error = None
+  try:
+    for im, final_name in items:
+      worker_writer.save(im, final_name, im.file)
+  except Exception:
+    error = traceback.format_exc()
+  # lets go of the atlases before unmapping them
+  im = None; items.clear()
+  release_attached_arrays()
+  return error, _get_worker_stats()
+
+class ProcessWriter(PNGWriter):
+  # PNGWriter handing DeferredSprites to a process pool initialized with
+  # _init_worker, chunk_size at a time, to be rendered and saved there; their
+  # atlases are to come from a SharedAtlasCache, so no copies get sent
+  deferred = True
+
+  def __init__(self, pool, chunk_size=4, save_kwargs=None):
+    super().__init__(0, save_kwargs=save_kwargs)
+    self.process_pool = pool; self.chunk_size = chunk_size
+    self.chunk = list()
+
+  def submit(self, im, final_name):
+    self.chunk.append((im, final_name))
+    if len(self.chunk) >= self.chunk_size:
+      self.submit_chunk()
+
+  def submit_chunk(self):
+    if self.chunk:
+      self.pending.append(self.process_pool.submit(_save_deferred, self.chunk))
+      self.chunk = list()
+
+  def flush(self, ignore_errors=False):
+    if ignore_errors:
+      self.chunk = list()
+    self.submit_chunk()
+    pending = self.pending; self.pending = list()
+    errors = list()
+    for future in pending:
+      try:
+        error, (pid, counters, profile) = future.result()
+      except Exception:
+        error = traceback.format_exc(); profile = None
+      if profile:
+        undice_profile.profiler.merge(profile)
+      if error:
+        errors.append(error)
+    if errors and not ignore_errors:
+      raise RuntimeError(f'saving in a worker failed:\n{errors[0]}')
+
+  def close(self):
+    self.flush() # the pool is the caller's to shut down
+
+def produce_undiced_shared(
+  infile_paths, outfold='out/', verbose=False, jobs=None, atlas_cache=None,
+  writer=None, manifest=None, dir_images=None, **kwargs
+):
+  # like produce_undiced_pool, but files are undiced one at a time here, with
+  # their atlases decoded once into shared memory and their sprites rendered
+  # and saved by jobs processes mapping it, so there's one copy of an atlas
+  # however many jobs; kwargs are passed on to produce_undiced
+  from concurrent.futures import ProcessPoolExecutor
+  if atlas_cache is None:
+    atlas_cache = AtlasCache()
+  if writer is None:
+    writer = PNGWriter(0)
+  shared_cache = SharedAtlasCache(atlas_cache.max_bytes)
+  failures = list()
+  os.makedirs(outfold, exist_ok=True)
+  with make_staging_root(outfold) as staging_root, ProcessPoolExecutor(
+    jobs, initializer=_init_worker,
+    initargs=(0, (0, None, writer.save_kwargs), bool(undice_profile.profiler))
+  ) as pool:
+    process_writer = ProcessWriter(pool, save_kwargs=writer.save_kwargs)
+    try:
+      for infile_path in infile_paths:
+        if verbose:
+          print('Undicing:', infile_path)
+        # staged as produce_undiced_serial does
+        staging = tempfile.mkdtemp(dir=staging_root); inputs = None
+        try:
+          saved = produce_undiced(
+            infile_path, staging, False, atlas_cache=shared_cache,
+            writer=process_writer, dir_images=dir_images, **kwargs
+          )
+          if manifest:
+            inputs = get_input_digests(
+              infile_path, manifest.digests, dir_images
+            )
+        except Exception:
+          shutil.rmtree(staging, ignore_errors=True)
+          report_failure(
+            failures, infile_path, traceback.format_exc(), verbose
+          )
+          continue
+        finally:
+          # nothing of this file's is left queued by now
+          shared_cache.release()
+        settle_staged(
+          infile_path, staging, saved, outfold, manifest, verbose,
+          inputs
+        )
+    finally:
+      shared_cache.close()
+  atlas_cache.add_counters(*shared_cache.counters())
+  return failures
+
+def produce_undiced_pool(
+  infile_paths, outfold='out/', verbose=False, jobs=None, atlas_cache=None,
+  writer=None, manifest=None, dir_images=None, **kwargs
+):
+  # kwargs are passed on to produce_undiced, with each file's part of
+  # dir_images (see get_folder_images); each worker keeps its own atlas
+  # cache capped like atlas_cache, whose counters get the workers' totals
+  # added to them at the end, and its own PNGWriter set up like writer;
+  # workers profile if undice_profile is enabled here, and their profiles
+  # are merged into it; files done are recorded in manifest if given;
+  # returns list of (infile_path, traceback str) for files that failed
+  from concurrent.futures import ProcessPoolExecutor
+  os.makedirs(outfold, exist_ok=True)
+  if atlas_cache is None:
+    atlas_cache = AtlasCache()
+  if writer is None:
+    writer = PNGWriter(0)
+  writer_args = (writer.threads, writer.max_pending, writer.save_kwargs)
+  failures = list(); worker_counters = dict()
+  # the pool is shut down before its staging goes
+  with make_staging_root(outfold) as staging_root, ProcessPoolExecutor(
+    jobs, initializer=_init_worker,
+    initargs=(
+      atlas_cache.max_bytes, writer_args, bool(undice_profile.profiler)
+    )
+  ) as pool:
+    futures = [
+      (infile_path, pool.submit(
+        _produce_undiced_staged, infile_path, staging_root, dict(
+          kwargs, dir_images=get_folder_images(dir_images, infile_path)
+        ), manifest is not None
+      )) for infile_path in infile_paths
+    ]
+    # results are moved into place strictly in submission order, which is the
+    # order a single job would have saved them in
+    for infile_path, future in futures:
+      if verbose:
+        print('Undicing:', infile_path)
+      try:
+        staging, saved, inputs, error, (pid, counters, profile) = \
+          future.result()
+        worker_counters[pid] = counters
+        if profile:
+          undice_profile.profiler.merge(profile)
+      except Exception:
+        staging, saved, inputs, error = \
+          None, None, None, traceback.format_exc()
+      if error:
+        report_failure(failures, infile_path, error, verbose)
+        continue
+      settle_staged(
+        infile_path, staging, saved, outfold, manifest, verbose, inputs
+      )
+  for counters in worker_counters.values():
+    atlas_cache.add_counters(*counters)
+  return failures
 
 if __name__ == '__main__':
   # if len(sys.argv) > 1:
   args = _init_parser().parse_args(sys.argv[1:])
-  for discrete_path in args.fpath:
-    if os.path.isfile(discrete_path):
-      produce_undiced(discrete_path, args.output_directory, args.verbose)
-    elif os.path.isdir(discrete_path):
-      for dpath, dnames, fnames in os.walk(discrete_path):
-        for fname in fnames:
-          produce_undiced(
-            os.path.join(dpath, fname),
-            args.output_directory,
-            args.verbose
+  undice_profile.enable_from_args(args)
+  atlas_cache = AtlasCache(args.atlas_cache_mb * 2**20)
+  writer = PNGWriter(args.save_threads, save_kwargs=get_png_save_kwargs(
+    not args.no_optimize, args.png_level
+  ))
+  wanted = partial(name_matches, tuple(args.only)) if args.only else None
+  # runs picking out sprites leave the manifest be, as they'd make it think
+  # files done whose other sprites weren't
+  manifest = None
+  if not (args.only or args.list):
+    manifest = Manifest(args.output_directory)
+  scan_cache = None; dir_images = dict()
+  if not args.no_scan_cache:
+    scan_cache = ScanCache(args.output_directory)
+  infile_paths = scan_fpaths(args.fpath, scan_cache, dir_images)
+  if manifest:
+    infile_paths = iter_outdated(
+      infile_paths, manifest, args.force, args.verbose
+    )
+  try:
+    if args.list:
+      failures = list()
+      for infile_path in infile_paths:
+        try:
+          print_sprite_index(
+            infile_path, args.verbose, args.use_unitypack, wanted, dir_images
+          )
+        except Exception:
+          report_failure(
+            failures, infile_path, traceback.format_exc(), args.verbose
           )
     else:
-      print(discrete_path, 'does not exist!')
+      if args.jobs > 1:
+        produce = partial(
+          produce_undiced_shared if args.shared_atlas else
+          produce_undiced_pool, jobs=args.jobs
+        )
+      else:
+        produce = produce_undiced_serial
+      failures = produce(
+        infile_paths, args.output_directory, args.verbose,
+        atlas_cache=atlas_cache, writer=writer, manifest=manifest,
+        dir_images=dir_images, use_unitypack=args.use_unitypack,
+        engine=args.engine, save_plans=args.save_plans, wanted=wanted,
+        band_height=args.bands, dedupe=args.dedupe
+      )
+    if failures:
+      print(len(failures), 'file(s) failed:')
+      for infile_path, error in failures:
+        print(' ', infile_path)
+  finally:
+    writer.close()
+    if manifest:
+      manifest.save()
+    if scan_cache and not args.list: # which writes nothing
+      scan_cache.save()
+  if args.verbose:
+    print('Atlas cache:', atlas_cache.stats())
+  undice_profile.report_from_args(args)
+  if failures:
+    sys.exit(1)
   # else:
     # arg = input('Input path to .mvl file: ')
     # basename = os.path.splitext(os.path.basename(arg))[0]
@@ -1,9 +1,13 @@
 import os
 import sys
 import argparse
+import traceback
 import numpy as np
 from PIL import Image
-from itertools import chain as iterchain, product as iterprod
+
+import undice_profile
+import undice_variants
+from undice_profile import stage
 
 def _init_parser():
   # copied and edited from https://github.com/HearthSim/python-fsb5/blob/master/extract.py
@@ -28,6 +32,19 @@ def _init_parser():
     '-w', '--overwrite', action='store_true', 
     help="If output file already exists, don't skip and overwrite it."
   )
+  parser.add_argument(
+    '-j', '--jobs', type=int, default=1, help=(
+      'number of processes to share the work between (default 1); each '
+      'takes whole trees of outputs built off the same first base at a time'
+    )
+  )
+  parser.add_argument(
+    '--cell-size', type=int, default=32, help=(
+      'size of the square cells variants are compared with their base in '
+      'for -t 1d stores (default 32)'
+    )
+  )
+  undice_profile.add_arguments(parser)
 
   return parser
 
@@ -42,83 +59,202 @@ a: Applies edge fuzz transparency (better trim, but may over-erase
    subtle art details starting from the edges)
 b: Solid colour trim (rids edges with any uniform colour, not just
    transparent pixels; not for BG art, especially solid colour)
+d: Differential store (with 1, instead of trimming): each first base and
+   the variants built off it go into one "<first base>.variants" file
+   holding the base once and, for each variant, only the cells that
+   differ from it; undice_variants.py gets variants, or crops of them,
+   back out
 Any combination of valid number/letters works.
 """.strip()
 
 ## image editing
+def _label_runs(mask):
+  # 8-connected components of mask, found over its horizontal runs of True:
+  # returns each run's row, start and end (exclusive) plus a label per run
+  # that's the same for runs in the same component
+  height, width = mask.shape
+  edges = np.diff(
+    np.pad(mask, ((0, 0), (1, 1))).astype(np.int8), axis=1
+  )
+  rows, starts = np.nonzero(edges == 1)
+  ends = np.nonzero(edges == -1)[1]
+  # runs touch the next row's runs starting up to one past their end and
+  # ending from one before their start; runs are in (row, column) order, so
+  # those are found for all runs at once by searching (row, column) keys
+  stride = width + 4
+  start_keys = rows * stride + starts + 1
+  last_keys = rows * stride + ends # last column ends - 1, plus 1
+  lo = np.searchsorted(last_keys, (rows + 1) * stride + starts)
+  hi = np.searchsorted(start_keys, (rows + 1) * stride + ends + 1, 'right')
+  counts = np.maximum(hi - lo, 0)
+  a = np.repeat(np.arange(len(rows)), counts)
+  b = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) \
+    + np.repeat(lo, counts)
+  # join labels across touching runs until nothing changes, hooking roots to
+  # the smaller label and then flattening chains
+  labels = np.arange(len(rows))
+  while len(a):
+    la = labels[a]; lb = labels[b]
+    if (la == lb).all():
+      break
+    smaller = np.minimum(la, lb)
+    np.minimum.at(labels, la, smaller); np.minimum.at(labels, lb, smaller)
+    while True:
+      flattened = labels[labels]
+      if (flattened == labels).all():
+        break
+      labels = flattened
+  return rows, starts, ends, labels
+
 def apply_edge_spread_transparency(im):
-  transparents = set(); ignores = set()
-  x, y = im.size
-  
-  def checktransparent(coor, store):
-    if not coor in ignores and not coor in store:
-      pixel = im.getpixel(coor)
-      if 0 < pixel[3] < 64:
-        return 1
-      elif 64 <= pixel[3]:
-        return 2
-      else:
-        ignores.add(coor)
-    return 0
-  
-  for coor in iterchain(
-    iterprod((0, x-1), range(y)), iterprod(range(x), (0, y-1))
-  ):
-    if coor in ignores:
-      continue
-    pix = im.getpixel(coor)
-    if 0 < pix[3] < 64:
-      # print('Found non-transparent pixel at', coor)
-      solid = False
-      store = {coor}; startpoints = [coor]
-      while startpoints:
-        workingpoints = set()
-        for acoor in startpoints:
-          for bcoor in iterprod(
-            range(max(acoor[0] - 1, 0), min(acoor[0] + 2, x)),
-            range(max(acoor[1] - 1, 0), min(acoor[1] + 2, y))
-          ):
-            res = checktransparent(bcoor, store)
-            if res == 2:
-              solid = True
-              break
-            elif res == 1:
-              workingpoints.add(bcoor)
-          if solid:
-            break
-        store.update(workingpoints)
-        # print('Workingpoints: ', str(workingpoints)); # sleep(2)
-        if solid:
-          break
-        startpoints = workingpoints
-      if not solid:
-        transparents.update(store)
-        # print('Updated set to transparents')
-      # not conditioning the below under only if solid, just in case
-      # something unexpected happens
-      ignores.update(store)
-    elif 0 == pix[3]:
-      ignores.add(coor)
-  
-  for coor in transparents:
-    im.putpixel(coor, (0,0,0,0))
+  # clears faint (0 < alpha < 64) areas reaching the edges of RGBA im that
+  # aren't joined onto anything solid (alpha >= 64), i.e. 8-connected areas
+  # of faint pixels with a pixel on the border and none next to a solid one;
+  # done in place, returning the bbox of what's left (as getbbox() would)
+  pixels = np.array(im)
+  alpha = pixels[:, :, 3]
+  height, width = alpha.shape
+  faint = (alpha > 0) & (alpha < 64)
+  if faint[[0, -1]].any() or faint[:, [0, -1]].any():
+    rows, starts, ends, labels = _label_runs(faint)
+    # solid pixels spread to their 8 neighbours, then counted along each row
+    near_solid = np.pad(alpha >= 64, 1)
+    near_solid = near_solid[:, :-2] | near_solid[:, 1:-1] | near_solid[:, 2:]
+    near_solid = near_solid[:-2] | near_solid[1:-1] | near_solid[2:]
+    solid_counts = np.pad(np.cumsum(near_solid, axis=1), ((0, 0), (1, 0)))
+    touches_solid = \
+      solid_counts[rows, ends] - solid_counts[rows, starts] > 0
+    touches_border = (rows == 0) | (rows == height - 1) | (starts == 0) | \
+      (ends == width)
+    on_border = np.zeros(len(rows), dtype=bool)
+    on_border[labels[touches_border]] = True
+    held = np.zeros(len(rows), dtype=bool)
+    held[labels[touches_solid]] = True
+    cleared = on_border[labels] & ~held[labels]
+    if cleared.any():
+      runs = np.zeros((height, width + 1), dtype=np.int32)
+      np.add.at(runs, (rows[cleared], starts[cleared]), 1)
+      np.add.at(runs, (rows[cleared], ends[cleared]), -1)
+      pixels[np.cumsum(runs, axis=1)[:, :width] > 0] = 0
+      im.paste(Image.fromarray(pixels, 'RGBA'))
+  filled_rows = np.nonzero(alpha.any(axis=1))[0]
+  if not len(filled_rows):
+    return None
+  filled_cols = np.nonzero(alpha.any(axis=0))[0]
+  return (
+    int(filled_cols[0]), int(filled_rows[0]),
+    int(filled_cols[-1]) + 1, int(filled_rows[-1]) + 1
+  )
+
+def open_layer(fname):
+  with stage('decode') as counts:
+    im = Image.open(fname)
+    im.load()
+    counts['pixels'] = im.size[0] * im.size[1]
+    if undice_profile.profiler:
+      counts['bytes_in'] = os.path.getsize(fname)
+  return im
 
-def alpha_composite_fnames_list(fnames_list, bank=dict()):
+def alpha_composite_fnames_list(fnames_list, bank=None):
+  if bank is None:
+    bank = dict()
   key = fnames_list[0]
   if not key in bank:
-    im = Image.open(key)
+    im = open_layer(key)
     bank[key] = im
   else:
     im = bank[key]
   for key in fnames_list[1:]:
     if not key in bank:
-      subim = Image.open(key)
+      subim = open_layer(key)
       bank[key] = subim
     else:
       subim = bank[key]
-    im = Image.alpha_composite(im, subim)
+    with stage('composite') as counts:
+      im = Image.alpha_composite(im, subim)
+      counts['pixels'] = im.size[0] * im.size[1]
   return im, bank
 
+def iter_composited_tree(
+  dirpath, treedict, wanted=None, below=None, boxes=False
+):
+  # depth-first over a get_fnames_tree() tree, yielding (fname, image) for
+  # each leaf (if wanted(fname)) composited as alpha_composite_fnames_list()
+  # would, but with each base composited only once for everything built off
+  # it, and only while a wanted leaf is left under it; holds one image per
+  # level meanwhile
+  # layers are only composited within the union of their getbbox()es, so
+  # images come out already cropped as getbbox() would (or whole if all
+  # blank); below is (image, its box, full size) of the bases composited;
+  # boxes has the box each image was cropped to yielded after it
+  if wanted:
+    treedict = prune_tree(dirpath, treedict, wanted)
+  for key, subtree in treedict.items():
+    if key == 'level_len?':
+      continue
+    fname = os.path.join(dirpath, key)+'.png'
+    im = open_layer(fname)
+    below_im, below_box, size = below or (None, None, im.size)
+    if im.size != size:
+      raise ValueError('images do not match')
+    box = _union_box(below_box, im.getbbox())
+    if box is None and not subtree:
+      box = (0, 0) + size
+    if box is None:
+      im = None
+    else:
+      im = im.crop(box)
+      if below_im is not None:
+        with stage('composite') as counts:
+          if below_box != box:
+            # where below is blank, what's composited onto it shows as is
+            canvas = Image.new('RGBA', im.size)
+            canvas.paste(below_im, (below_box[0]-box[0], below_box[1]-box[1]))
+            below_im = canvas
+          im = Image.alpha_composite(im, below_im)
+          counts['pixels'] = im.size[0] * im.size[1]
+    if subtree:
+      yield from iter_composited_tree(
+        dirpath, subtree, None, (im, box, size), boxes
+      )
+    elif boxes:
+      yield fname, im, box
+    else:
+      yield fname, im
+    del im, below_im
+
+def _union_box(box, other):
+  if box is None or other is None:
+    return other or box
+  return (
+    min(box[0], other[0]), min(box[1], other[1]),
+    max(box[2], other[2]), max(box[3], other[3])
+  )
+
+def prune_tree(dirpath, treedict, wanted):
+  # copy of a get_fnames_tree() tree with only the branches leading to a leaf
+  # wanted(fname) is true for, each node looked at once
+  pruned = dict()
+  for key, subtree in treedict.items():
+    if key == 'level_len?':
+      pruned[key] = subtree
+    elif subtree:
+      subtree = prune_tree(dirpath, subtree, wanted)
+      if len(subtree) > 1: # more than its 'level_len?'
+        pruned[key] = subtree
+    elif wanted(os.path.join(dirpath, key)+'.png'):
+      pruned[key] = subtree
+  return pruned
+
+def iter_tree_leaves(dirpath, treedict):
+  for key, subtree in treedict.items():
+    if key == 'level_len?':
+      continue
+    if subtree:
+      yield from iter_tree_leaves(dirpath, subtree)
+    else:
+      yield os.path.join(dirpath, key)+'.png'
+
 # first try, but thought a-composition could be saved till after checking file
 # exists to save processing power, assuming it's applicable here
 # note to self: check later if it's opening PIL Images or retaining PIL images
@@ -138,19 +274,6 @@ def alpha_composite_fnames_list(fnames_list, bank=dict()):
       # )
   # return composition_list
 
-def collate_fnames_tree(dirpath, treedict):
-  composition_list = list()
-  for key in treedict:
-    if key == 'level_len?':
-      continue
-    if not treedict[key]:
-      composition_list.append([os.path.join(dirpath, key)+'.png'])
-    else:
-      for fnames_list in collate_fnames_tree(dirpath, treedict[key]):
-        fnames_list.append(os.path.join(dirpath, key)+'.png')
-        composition_list.append(fnames_list)
-  return composition_list
-
 def get_fnames_tree(fnames):
   subtree = dict()
   for fname in fnames:
@@ -219,37 +342,226 @@ def gettrimbox2(im): # about one second for one use of this one
       c -= 1
   return bounds
 
+def _count_leading(mask):
+  return len(mask) if mask.all() else int(np.argmin(mask))
+
+def gettrimbox3(im): # same as gettrimbox2, with one pass over the pixels
+  # packs RGBA pixels into uint32 once and notes where each differs from its
+  # right and lower neighbours; rows from a to c are uniform when none
+  # differ there, so a pass finds all uniform rows (columns) of the box at
+  # once, and only the shrunken box is looked at again if it moved
+  if im.mode != 'RGBA':
+    im = im.convert('RGBA')
+  packed = np.asarray(im).view(np.uint32)[:, :, 0]
+  changes_across = packed[:, 1:] != packed[:, :-1]
+  changes_down = packed[1:] != packed[:-1]
+  bounds = tuple(); a, b, c, d = [0, 0] + list(im.size)
+  while bounds != (a, b, c, d):
+    bounds = (a, b, c, d)
+    uniform = ~changes_across[b:d, a:c-1].any(axis=1)
+    top = min(b + _count_leading(uniform), d - 1)
+    d = max(d - _count_leading(uniform[top-b:][::-1]), top + 1); b = top
+    uniform = ~changes_down[b:d-1, a:c].any(axis=0)
+    left = min(a + _count_leading(uniform), c - 1)
+    c = max(c - _count_leading(uniform[left-a:][::-1]), left + 1); a = left
+  return bounds
+
+## batch processing
+def process_composited(im, process_type):
+  # trims im, of transparency or with 'b' in process_type of solid colour,
+  # and with 'a' clears edge fuzz, trimming again until nothing comes off
+  if 'b' in process_type:
+    getboundary = gettrimbox3
+  else:
+    getboundary = lambda x: x.getbbox()
+  with stage('trim') as counts:
+    counts['pixels'] = im.size[0] * im.size[1]
+    im = im.crop(getboundary(im))
+  if 'a' in process_type:
+    # clearing may bare new edges, so repeats until nothing's cut;
+    # the bbox it hands back saves getbbox() looking again
+    while True:
+      with stage('edge_spread') as counts:
+        counts['pixels'] = im.size[0] * im.size[1]
+        bbox = apply_edge_spread_transparency(im)
+      if 'b' in process_type:
+        with stage('trim') as counts:
+          counts['pixels'] = im.size[0] * im.size[1]
+          bbox = getboundary(im)
+      if bbox is None or bbox == (0, 0) + im.size:
+        break
+      with stage('trim') as counts:
+        counts['pixels'] = im.size[0] * im.size[1]
+        im = im.crop(bbox)
+  return im
+
+def store_tree_variants(
+  dirpath, treedict, fpath, outfold, overwrite=False, verbose=False,
+  failures=None, cell_size=32
+):
+  # 'd' counterpart of afterprocess_tree(): each first base of the tree,
+  # with the composited outputs built off it, goes into one variant store in
+  # outfold where the base was under fpath
+  for key, subtree in treedict.items():
+    if key == 'level_len?':
+      continue
+    outpath = outfold + os.path.join(dirpath, key)[len(fpath):] + '.variants'
+    if not overwrite and os.path.isfile(outpath):
+      print('Skipped', outpath)
+      continue
+    undice_profile.set_file(outpath)
+    try:
+      os.makedirs(os.path.dirname(outpath), exist_ok=True)
+      base = open_layer(os.path.join(dirpath, key)+'.png')
+      variants = (
+        (os.path.basename(fname)[:-len('.png')], im, box)
+        for fname, im, box in iter_composited_tree(
+          dirpath, {'level_len?': treedict['level_len?'], key: subtree},
+          boxes=True
+        )
+      )
+      if verbose:
+        print('Saving', outpath)
+      undice_variants.write_store(outpath, base, variants, cell_size, key)
+    except Exception:
+      if failures is None:
+        raise
+      failures.append((outpath, traceback.format_exc()))
+
+def afterprocess_tree(
+  dirpath, treedict, fpath, outfold, process_type, overwrite=False,
+  verbose=False, failures=None, cell_size=32
+):
+  # composites and processes the outputs of a get_fnames_tree() tree of
+  # files in dirpath, saving each into outfold where it was under fpath;
+  # outputs already there are skipped unless overwrite; if failures is a
+  # list, (outpath, traceback str) of outputs that fail are put on it rather
+  # than raised; with 'd' in process_type, store_tree_variants() instead
+  if 'd' in process_type:
+    return store_tree_variants(
+      dirpath, treedict, fpath, outfold, overwrite, verbose, failures,
+      cell_size
+    )
+  wanted = dict()
+  for fname in iter_tree_leaves(dirpath, treedict):
+    outpath = outfold + fname[len(fpath):]
+    if not overwrite and os.path.isfile(outpath):
+      print('Skipped', outpath)
+      continue
+    wanted[fname] = outpath
+  # bases shared between outputs are counted against their folder
+  undice_profile.set_file(dirpath)
+  try:
+    for fname, im in iter_composited_tree(
+      dirpath, treedict, wanted.__contains__
+    ):
+      outpath = wanted.pop(fname)
+      try:
+        os.makedirs(os.path.dirname(outpath), exist_ok=True)
+        undice_profile.set_file(outpath)
+        im = process_composited(im, process_type)
+        if verbose:
+          print('Saving', outpath)
+        with stage('save') as counts:
+          im.save(outpath, optimize=True)
+          counts['pixels'] = im.size[0] * im.size[1]
+          if undice_profile.profiler:
+            counts['bytes_out'] = os.path.getsize(outpath)
+      except Exception:
+        if failures is None:
+          raise
+        failures.append((outpath, traceback.format_exc()))
+      undice_profile.set_file(dirpath)
+  except Exception:
+    if failures is None:
+      raise
+    # a base that can't be opened or composited fails all outputs left
+    error = traceback.format_exc()
+    failures.extend((outpath, error) for outpath in wanted.values())
+
+def iter_partitions(fpath):
+  # (dirpath, tree) for each first base of the trees of folders under fpath,
+  # with everything built off it
+  for dirpath, dirnames, fnames in os.walk(fpath):
+    if fnames:
+      treedict = get_fnames_tree(fnames)
+      for key, subtree in treedict.items():
+        if key != 'level_len?':
+          yield dirpath, {'level_len?': treedict['level_len?'], key: subtree}
+
+def _init_worker(profile):
+  if profile:
+    undice_profile.enable()
+
+def _afterprocess_partition(*args, **kwargs):
+  # pool worker: returns failures as afterprocess_tree() puts them and the
+  # profile since last call or None
+  failures = list()
+  afterprocess_tree(*args, failures=failures, **kwargs)
+  profile = None
+  if undice_profile.profiler:
+    profile = undice_profile.profiler.as_dict()
+    undice_profile.profiler.reset()
+  return failures, profile
+
+def afterprocess_pool(
+  fpath, outfold, process_type, overwrite=False, verbose=False, jobs=None,
+  cell_size=32
+):
+  # afterprocess_tree() for every partition of iter_partitions(fpath) in a
+  # process pool, so each worker keeps the bases it composited to itself;
+  # workers profile if undice_profile is enabled here, and their profiles
+  # are merged into it; returns list of (outpath, traceback str) that failed
+  from concurrent.futures import ProcessPoolExecutor
+  failures = list()
+  with ProcessPoolExecutor(
+    jobs, initializer=_init_worker, initargs=(bool(undice_profile.profiler),)
+  ) as pool:
+    futures = [
+      (dirpath, pool.submit(
+        _afterprocess_partition, dirpath, treedict, fpath, outfold,
+        process_type, overwrite, verbose, cell_size=cell_size
+      )) for dirpath, treedict in iter_partitions(fpath)
+    ]
+    for dirpath, future in futures:
+      try:
+        partition_failures, profile = future.result()
+        if profile:
+          undice_profile.profiler.merge(profile)
+      except Exception:
+        partition_failures = [(dirpath, traceback.format_exc())]
+      for outpath, error in partition_failures:
+        print('Failed:', outpath)
+        print(error if verbose else error.strip().splitlines()[-1])
+      failures.extend(partition_failures)
+  return failures
+
 if __name__ == '__main__':
   args = _init_parser().parse_args(sys.argv[1:])
+  undice_profile.enable_from_args(args)
   if not args.process_type:
     print('No process type inputted! Select among the following:')
     print(processing_text)
     args.process_type = input('Enter here (empty field will exit program): ')
   if args.process_type:
     if '1' in args.process_type:
-      for dirpath, dirnames, fnames in os.walk(args.fpath):
-        if fnames:
-          treedict = get_fnames_tree(fnames); bank = dict()
-          for fnames_list in collate_fnames_tree(dirpath, treedict):
-            outpath = args.output_directory + fnames_list[0][len(args.fpath):]
-            if not args.overwrite and os.path.isfile(outpath):
-              print('Skipped', outpath)
-              continue
-            os.makedirs(os.path.dirname(outpath), exist_ok=True)
-            im, bank = alpha_composite_fnames_list(fnames_list, bank)
-            if 'b' in args.process_type:
-              getboundary = gettrimbox2
-            else:
-              getboundary = lambda x: x.getbbox()
-            im = im.crop(getboundary(im))
-            if 'a' in args.process_type:
-              apply_edge_spread_transparency(im)
-              while getboundary(im) != (0, 0) + im.size:
-                im = im.crop(getboundaary(im))
-                apply_edge_spread_transparency(im)
-            if args.verbose:
-              print('Saving', outpath)
-            im.save(outpath, optimize=True)
+      if args.jobs > 1:
+        failures = afterprocess_pool(
+          args.fpath, args.output_directory, args.process_type,
+          args.overwrite, args.verbose, args.jobs, args.cell_size
+        )
+        if failures:
+          print(len(failures), 'file(s) failed:')
+          for outpath, error in failures:
+            print(' ', outpath)
+      else:
+        for dirpath, dirnames, fnames in os.walk(args.fpath):
+          if fnames:
+            afterprocess_tree(
+              dirpath, get_fnames_tree(fnames), args.fpath,
+              args.output_directory, args.process_type, args.overwrite,
+              args.verbose, cell_size=args.cell_size
+            )
 
     # confirm = input('\nRemove recent outputs to out/ folder? y/n> ')
     # if confirm and confirm[0].lower() == 'y':
@@ -258,3 +570,4 @@ if __name__ == '__main__':
   # else:
     # print('No processing done.')
   # input('Finished! Press ENTER to exit program...')
+  undice_profile.report_from_args(args)
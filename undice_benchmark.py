@@ -0,0 +1,289 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+from io import BytesIO
+from math import ceil
+from struct import pack
+
+import numpy as np
+from PIL import Image, __version__ as pil_version
+
+import undice
+import undice_afterprocess
+
+def _init_parser():
+  description = (
+    "Times undicing and afterprocessing stages on synthetic diced atlases "
+    "with matching JSON and MVL files, and reports throughput as JSON."
+  )
+  parser = argparse.ArgumentParser(description=description)
+  parser.add_argument(
+    '-o', '--output', type=str,
+    help='file to write JSON results into (default: print them)'
+  )
+  parser.add_argument(
+    '--cell-size', type=int, default=64,
+    help='dicing cell size in pixels (default 64)'
+  )
+  parser.add_argument(
+    '--padding', type=int, default=3,
+    help='dicing cell padding in pixels (default 3)'
+  )
+  parser.add_argument(
+    '--sprites', type=int, default=32,
+    help='number of sprites in each of the JSON and MVL (default 32)'
+  )
+  parser.add_argument(
+    '--atlas-size', type=str, default='2048x2048',
+    help='atlas width x height; multiples of cell size (default 2048x2048)'
+  )
+  parser.add_argument(
+    '--sprite-size', type=str, default='512x768',
+    help='width x height of each sprite (default 512x768)'
+  )
+  parser.add_argument(
+    '--quads', type=int, default=200,
+    help='quads pasted for each MVL sprite (default 200)'
+  )
+  parser.add_argument(
+    '--repeat', type=int, default=3,
+    help='times to run each stage, keeping the fastest (default 3)'
+  )
+  parser.add_argument(
+    '--seed', type=int, default=0, help='random seed (default 0)'
+  )
+  parser.add_argument(
+    '--skip', type=str, default='',
+    help='comma separated stages to leave out, e.g. "edge_spread,trim"'
+  )
+  return parser
+
+def _parse_size(text):
+  width, height = text.lower().split('x')
+  return int(width), int(height)
+
+## synthetic data
+def make_atlas(rng, atlas_size):
+  width, height = atlas_size
+  data = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+  return Image.fromarray(data, 'RGBA')
+
+def make_dicing(
+  rng, atlas_names, atlas_size, sprites, sprite_size, cellSize, padding
+):
+  # JSON as exported from a DicingTextures MonoBehaviour
+  pasteSize = cellSize - 2*padding
+  cells = (atlas_size[0] // cellSize) * (atlas_size[1] // cellSize)
+  blocks = ceil(sprite_size[0] / pasteSize) * ceil(sprite_size[1] / pasteSize)
+  return {
+    'm_Enabled': 1, 'cellSize': cellSize, 'padding': padding,
+    'textureDataList': [{
+      'name': f'sprite{n:04}', 'atlasName': atlas_names[n % len(atlas_names)],
+      'width': sprite_size[0], 'height': sprite_size[1],
+      'cellIndexList': rng.integers(0, cells, blocks).tolist()
+    } for n in range(sprites)]
+  }
+
+def make_mvl(rng, atlas_size, sprites, sprite_size, quads):
+  # MVL laid out as process_mvl_data expects: header, entry table, one
+  # coordinate bank per entry, then each entry's index sets
+  basew, baseh = atlas_size; width, height = sprite_size
+  banks = list()
+  for n in range(sprites):
+    # up to 63 pixels a side, less if the atlas or sprite is smaller
+    capw = min(64, basew, width); caph = min(64, baseh, height)
+    qw = rng.integers(min(4, capw - 1), capw, quads)
+    qh = rng.integers(min(4, caph - 1), caph, quads)
+    sx = rng.integers(0, basew - qw); sy = rng.integers(0, baseh - qh)
+    dx = rng.integers(0, width - qw) - width // 2
+    dy = rng.integers(0, height - qh)
+    bank = np.zeros((quads, 4, 5), dtype='<f4')
+    for corner, (right, down) in enumerate(((0, 0), (1, 0), (0, 1), (1, 1))):
+      bank[:, corner, 0] = dx + right * qw; bank[:, corner, 1] = dy + down * qh
+      bank[:, corner, 3] = (sx + right * qw) / basew
+      bank[:, corner, 4] = (sy + down * qh) / baseh
+    banks.append(bank)
+  indices = (
+    np.arange(quads, dtype='<i2')[:, None] * 4 +
+    np.array([0, 1, 2, 1, 3, 2], dtype='<i2')
+  ).astype('<i2')
+  bank_address = 96 + 64 * sprites
+  index_address = bank_address + sum(bank.nbytes for bank in banks)
+  data = b'MVL1' + pack('<i', sprites) + b'\x00\x10' + 22 * b'\x00' + \
+    b'XFYF0FUFVF' + 54 * b'\x00'
+  for n, bank in enumerate(banks):
+    data += pack('<2i', width, height) + b'\x04\x01\x00\x01\x00\x00\x00\x00'
+    data += pack('<2i', 4 * quads, bank_address)
+    data += pack('<2i', indices.size, index_address)
+    data += f'sprite{n:04}'.encode().ljust(32, b'\x00')
+    bank_address += bank.nbytes; index_address += indices.nbytes
+  for bank in banks:
+    data += bank.tobytes()
+  for bank in banks:
+    data += indices.tobytes()
+  return data
+
+def make_layers(rng, size):
+  # base with a solid-ish body and faint fringe, plus a part under it, as
+  # undice_afterprocess puts a leaf under its parents
+  width, height = size
+  base = np.zeros((height, width, 4), dtype=np.uint8)
+  body = base[height//8:height - height//8, width//4:width - width//4]
+  body[:] = rng.integers(0, 256, body.shape, dtype=np.uint8) | \
+    np.array([0, 0, 0, 64], dtype=np.uint8)
+  base[height//16:height//8, width//4:width - width//4, 3] = 20
+  part = np.zeros_like(base)
+  part[height//4:height//2, width//3:width - width//3] = 255
+  return Image.fromarray(base, 'RGBA'), Image.fromarray(part, 'RGBA')
+
+## timing
+def peak_rss_mb():
+  # high-water mark of the whole process so far, never lowered
+  try:
+    import resource
+  except ImportError: # not on unix
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kilobytes on linux, bytes on macOS
+  return peak / (2**20 if sys.platform == 'darwin' else 2**10)
+
+def time_stage(results, stage, fn, sprites, pixels, repeat):
+  # fastest of repeat runs of fn, which handles sprites sprites of pixels
+  # pixels in total; as the peak can't be reset, a stage's own memory use
+  # shows as how far it raised the peak, 0 if it stayed under earlier ones
+  best = None; peak_before = peak_rss_mb()
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  results[stage] = {
+    'seconds': best, 'sprites': sprites, 'mpix': pixels / 1e6,
+    'sprites_per_s': sprites / best if best else None,
+    'mpix_per_s': pixels / 1e6 / best if best else None,
+    'peak_rss_growth_mb': peak_before and peak_rss_mb() - peak_before,
+    'cumulative_peak_rss_mb': peak_rss_mb()
+  }
+  print(
+    f'{stage:>24}: {best:8.3f}s {sprites / best if best else 0:10.1f} '
+    'sprites/s', file=sys.stderr
+  )
+
+def run_benchmarks(args):
+  rng = np.random.default_rng(args.seed)
+  atlas_size = _parse_size(args.atlas_size)
+  sprite_size = _parse_size(args.sprite_size)
+  assert atlas_size[0] % args.cell_size == 0 and \
+    atlas_size[1] % args.cell_size == 0, 'atlas size not multiple of cells!'
+  skip = set(filter(None, args.skip.split(',')))
+  pixels = args.sprites * sprite_size[0] * sprite_size[1]
+  stages = dict()
+
+  def stage(name, fn, sprites=args.sprites, stage_pixels=pixels):
+    if not name in skip:
+      time_stage(stages, name, fn, sprites, stage_pixels, args.repeat)
+
+  with tempfile.TemporaryDirectory(prefix='undice-bench-') as tmp:
+    atlas = make_atlas(rng, atlas_size)
+    atlas.save(os.path.join(tmp, 'atlas.png'))
+    dicing = make_dicing(
+      rng, ['atlas'], atlas_size, args.sprites, sprite_size, args.cell_size,
+      args.padding
+    )
+    json_path = os.path.join(tmp, 'dicing.json')
+    with open(json_path, 'w') as f:
+      json.dump(dicing, f)
+    mvl_path = os.path.join(tmp, 'atlas_.mvl')
+    with open(mvl_path, 'wb') as f:
+      f.write(make_mvl(rng, atlas_size, args.sprites, sprite_size, args.quads))
+
+    stage('decode_atlas', lambda: undice.open_atlas(
+      os.path.join(tmp, 'atlas.png')
+    ), 1, atlas_size[0] * atlas_size[1])
+    atlas_array = undice.get_atlas_array(atlas)
+
+    def parse_json():
+      with open(json_path, 'rb') as f:
+        json.load(f)
+    stage('parse_json', parse_json)
+
+    def parse_mvl():
+      with open(mvl_path, 'rb') as f:
+        return undice.compile_mvl_plans(
+          undice.process_mvl_data(f), *atlas_size
+        )
+    stage('parse_mvl', parse_mvl)
+    plans = parse_mvl()
+
+    for engine, base in (('pil', atlas), ('numpy', atlas_array)):
+      # atlas array conversion is part of each JSON's cost, so starts afresh
+      stage(f'reconstruct_json_{engine}', lambda: [
+        None for _ in undice.iter_undice_json(
+          dicing, {'atlas': atlas}, engine
+        )
+      ])
+      stage(f'reconstruct_mvl_{engine}', lambda: [
+        None for _ in undice.iter_undice_mvl_plans(base, plans, engine)
+      ])
+
+    sprite = undice.undice_texture_data_np(
+      atlas_array, dicing['textureDataList'][0], args.cell_size, args.padding
+    )[1]
+    # composited as undice_afterprocess does a leaf and its parent: lists go
+    # leaf first, each layer after going over it
+    base, part = make_layers(rng, sprite_size)
+    layers = {'base': base, 'part': part}
+    def composite():
+      return undice_afterprocess.alpha_composite_fnames_list(
+        ['part', 'base'], layers
+      )[0]
+    stage('composite', lambda: [composite() for _ in range(args.sprites)])
+    composited = composite()
+    stage('trim_getbbox', lambda: [
+      composited.getbbox() for _ in range(args.sprites)
+    ])
+    stage('trim_gettrimbox2', lambda: [
+      undice_afterprocess.gettrimbox2(composited) for _ in range(args.sprites)
+    ])
+    stage('trim_gettrimbox3', lambda: [
+      undice_afterprocess.gettrimbox3(composited) for _ in range(args.sprites)
+    ])
+    stage('edge_spread', lambda: [
+      undice_afterprocess.apply_edge_spread_transparency(composited.copy())
+      for _ in range(args.sprites)
+    ])
+
+    def encode(**save_kwargs):
+      for _ in range(args.sprites):
+        sprite.save(BytesIO(), 'PNG', **save_kwargs)
+    stage('encode_png_optimize', lambda: encode(optimize=True))
+    stage('encode_png_level1', lambda: encode(compress_level=1))
+
+  return {
+    'config': {
+      'cell_size': args.cell_size, 'padding': args.padding,
+      'sprites': args.sprites, 'atlas_size': list(atlas_size),
+      'sprite_size': list(sprite_size), 'quads': args.quads,
+      'repeat': args.repeat, 'seed': args.seed
+    },
+    'environment': {
+      'python': platform.python_version(), 'numpy': np.__version__,
+      'pillow': pil_version, 'platform': platform.platform(),
+      'cpu_count': os.cpu_count()
+    },
+    'stages': stages,
+    'cumulative_peak_rss_mb': peak_rss_mb()
+  }
+
+if __name__ == '__main__':
+  args = _init_parser().parse_args(sys.argv[1:])
+  results = run_benchmarks(args)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+  else:
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+# per-stage wall time, call counts, bytes and pixels for undice.py and
+# undice_afterprocess.py --profile; while not enabled, stage() hands out a
+# do-nothing context, so the instrumented code costs next to nothing
+
+profiler = None
+
+# counts written while profiling is off go here and are never read
+_discard = dict()
+_off = nullcontext(_discard)
+
+COUNTERS = ('calls', 'seconds', 'bytes_in', 'bytes_out', 'pixels')
+
+def enable():
+  global profiler
+  if profiler is None:
+    profiler = Profiler()
+  return profiler
+
+def stage(name, file=None):
+  # context yielding a dict to put 'bytes_in', 'bytes_out' and 'pixels' of
+  # the work done in it; file defaults to the one set by set_file()
+  if profiler is None:
+    return _off
+  return profiler.stage(name, file)
+
+def set_file(file):
+  if profiler is not None:
+    profiler.file = file
+
+def get_file():
+  return profiler.file if profiler is not None else None
+
+class Profiler:
+  def __init__(self):
+    self.lock = threading.Lock(); self.file = None
+    self.start = time.perf_counter()
+    # name: [calls, seconds, bytes_in, bytes_out, pixels]
+    self.stages = dict()
+    # file: {name: [calls, seconds, bytes_in, bytes_out, pixels]}
+    self.files = dict()
+    # (name, file, perf_counter() at start, duration s, pid, thread id) for
+    # trace output; perf_counter() is comparable across pool processes
+    self.events = list()
+
+  @contextmanager
+  def stage(self, name, file=None):
+    counts = dict(); file = self.file if file is None else file
+    start = time.perf_counter()
+    try:
+      yield counts
+    finally:
+      self.add(name, file, start, time.perf_counter() - start, counts)
+
+  def add(self, name, file, start, seconds, counts):
+    row = [
+      1, seconds, counts.get('bytes_in', 0), counts.get('bytes_out', 0),
+      counts.get('pixels', 0)
+    ]
+    with self.lock:
+      for totals in (
+        self.stages.setdefault(name, [0] * 5),
+        self.files.setdefault(str(file), dict()).setdefault(name, [0] * 5)
+      ):
+        for n, value in enumerate(row):
+          totals[n] += value
+      self.events.append((
+        name, file, start, seconds, os.getpid(),
+        threading.get_ident()
+      ))
+
+  def as_dict(self):
+    with self.lock:
+      return {
+        'stages': {
+          name: dict(zip(COUNTERS, totals))
+          for name, totals in self.stages.items()
+        },
+        'files': {
+          file: {
+            name: dict(zip(COUNTERS, totals))
+            for name, totals in stages.items()
+          } for file, stages in self.files.items()
+        },
+        'events': list(self.events)
+      }
+
+  def reset(self):
+    with self.lock:
+      self.stages = dict(); self.files = dict(); self.events = list()
+
+  def merge(self, profile):
+    # profile is as_dict() of another Profiler, e.g. from a pool worker
+    with self.lock:
+      for name, totals in profile['stages'].items():
+        mine = self.stages.setdefault(name, [0] * 5)
+        for n, counter in enumerate(COUNTERS):
+          mine[n] += totals[counter]
+      for file, stages in profile['files'].items():
+        for name, totals in stages.items():
+          mine = self.files.setdefault(file, dict()).setdefault(name, [0] * 5)
+          for n, counter in enumerate(COUNTERS):
+            mine[n] += totals[counter]
+      self.events.extend(tuple(event) for event in profile['events'])
+
+  def summary(self):
+    lines = [
+      f'{"stage":<16}{"calls":>8}{"total s":>10}{"mean ms":>10}'
+      f'{"MB in":>10}{"MB out":>10}{"MPix":>10}{"MPix/s":>10}'
+    ]
+    with self.lock:
+      stages = sorted(self.stages.items(), key=lambda item: -item[1][1])
+    for name, (calls, seconds, bytes_in, bytes_out, pixels) in stages:
+      lines.append(
+        f'{name:<16}{calls:>8}{seconds:>10.3f}'
+        f'{1000 * seconds / calls if calls else 0:>10.2f}'
+        f'{bytes_in / 2**20:>10.1f}{bytes_out / 2**20:>10.1f}'
+        f'{pixels / 1e6:>10.1f}'
+        f'{pixels / 1e6 / seconds if seconds else 0:>10.1f}'
+      )
+    lines.append(
+      f'wall time: {time.perf_counter() - self.start:.3f}s '
+      '(stages may overlap when run on threads or processes)'
+    )
+    return '\n'.join(lines)
+
+  def dump_json(self, path):
+    profile = self.as_dict(); del profile['events']
+    with open(path, 'w') as f:
+      json.dump(profile, f, indent=1)
+
+  def dump_trace(self, path):
+    # Chrome trace event format, for chrome://tracing or Perfetto
+    with self.lock:
+      events = list(self.events)
+    with open(path, 'w') as f:
+      json.dump({'traceEvents': [{
+        'name': name, 'cat': 'undice', 'ph': 'X',
+        'ts': (start - self.start) * 1e6,
+        'dur': seconds * 1e6, 'pid': pid, 'tid': tid,
+        'args': {'file': str(file)}
+      } for name, file, start, seconds, pid, tid in events]}, f)
+
+def add_arguments(parser):
+  parser.add_argument(
+    '--profile', action='store_true', help=(
+      'time each stage of the work (decoding, parsing, rebuilding, '
+      'compositing, trimming, saving...) and print a summary at the end'
+    )
+  )
+  parser.add_argument(
+    '--profile-json', type=str, metavar='PATH', help=(
+      'write per-stage and per-file profile totals as JSON to PATH '
+      '(implies --profile)'
+    )
+  )
+  parser.add_argument(
+    '--profile-trace', type=str, metavar='PATH', help=(
+      'write every timed stage to PATH in Chrome trace format (implies '
+      '--profile)'
+    )
+  )
+
+def enable_from_args(args):
+  if args.profile or args.profile_json or args.profile_trace:
+    return enable()
+  return None
+
+def report_from_args(args):
+  if profiler is None:
+    return
+  print(profiler.summary())
+  if args.profile_json:
+    profiler.dump_json(args.profile_json)
+  if args.profile_trace:
+    profiler.dump_trace(args.profile_trace)
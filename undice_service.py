@@ -0,0 +1,419 @@
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import argparse
+import tempfile
+import threading
+import traceback
+from functools import partial
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import undice
+
+def _init_parser():
+  description = (
+    "Keeps undicing running as a local HTTP service, taking jobs of MVL, "
+    "JSON or assetbundle paths into a queue and running them on worker "
+    "threads that share decoded atlases and parsed MVLs across jobs."
+  )
+  parser = argparse.ArgumentParser(description=description)
+  parser.add_argument(
+    '--host', type=str, default='127.0.0.1',
+    help='address to listen on (default 127.0.0.1, i.e. this machine only)'
+  )
+  parser.add_argument(
+    '--port', type=int, default=8765, help='port to listen on (default 8765)'
+  )
+  parser.add_argument(
+    '--workers', type=int, default=2,
+    help='number of jobs run at once (default 2)'
+  )
+  parser.add_argument(
+    '--atlas-cache-mb', type=int, default=1024, help=(
+      'memory cap in MB for decoded atlases kept around for later jobs '
+      '(default 1024)'
+    )
+  )
+  parser.add_argument(
+    '--mvl-cache-files', type=int, default=256, help=(
+      'number of parsed MVL files kept around for later jobs (default 256)'
+    )
+  )
+  parser.add_argument(
+    '--save-threads', type=int, default=2, help=(
+      'number of threads encoding and writing PNGs for each job (default 2)'
+    )
+  )
+  parser.add_argument(
+    '--keep-jobs', type=int, default=1000, help=(
+      'number of finished jobs whose status is kept to be asked for '
+      '(default 1000)'
+    )
+  )
+  parser.add_argument(
+    '--verbose', action='store_true', help='log each request and job'
+  )
+  return parser
+
+# options a job may give, with their defaults; same meanings as undice.py's
+JOB_OPTIONS = {
+  'output_directory': 'out/', 'force': False, 'only': None,
+  'use_unitypack': False, 'engine': 'numpy', 'save_plans': False,
+  'no_optimize': False, 'png_level': None, 'bands': 0, 'dedupe': False
+}
+
+class MVLCache:
+  # least-recently-used dict of parsed MVL entries, for produce_undiced's
+  # mvl_cache, holding up to max_files files
+  def __init__(self, max_files=256):
+    self.max_files = max_files
+    self.entries = OrderedDict(); self.lock = threading.Lock()
+    self.hits = 0; self.misses = 0
+
+  def get(self, key):
+    with self.lock:
+      if key in self.entries:
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+      self.misses += 1
+      return None
+
+  def __setitem__(self, key, value):
+    with self.lock:
+      self.entries[key] = value
+      while len(self.entries) > self.max_files:
+        self.entries.popitem(last=False)
+
+  def stats(self):
+    with self.lock:
+      return {
+        'files': len(self.entries), 'hits': self.hits, 'misses': self.misses
+      }
+
+class Job:
+  # a request to undice paths, and how it's going; state goes queued,
+  # running, then done, failed (on an error outside any one file) or
+  # cancelled
+  def __init__(self, job_id, paths, options):
+    self.id = job_id; self.paths = paths; self.options = options
+    self.state = 'queued'; self.error = None; self.cancelling = False
+    self.created = time.time(); self.started = None; self.finished = None
+    self.current = None; self.total = None
+    # path: {'status', 'seconds', 'saved', 'error'} of files gone through
+    self.files = OrderedDict(); self.lock = threading.Lock()
+
+  def as_dict(self, files=True):
+    with self.lock:
+      results = OrderedDict(self.files)
+    counts = dict()
+    for result in results.values():
+      counts[result['status']] = counts.get(result['status'], 0) + 1
+    job = {
+      'id': self.id, 'state': self.state, 'paths': self.paths,
+      'options': self.options, 'error': self.error,
+      'created': self.created, 'started': self.started,
+      'finished': self.finished,
+      'queued_seconds': (self.started or time.time()) - self.created,
+      'run_seconds': self.started and (
+        (self.finished or time.time()) - self.started
+      ),
+      'progress': {
+        'files': self.total, 'done': len(results), 'current': self.current,
+        'undiced': counts.get('undiced', 0),
+        'unchanged': counts.get('unchanged', 0),
+        'skipped': counts.get('skipped', 0),
+        'failed': counts.get('failed', 0)
+      }
+    }
+    if files:
+      job['files'] = results
+    return job
+
+class Service:
+  # job queue with workers threads running jobs, all sharing an AtlasCache
+  # and an MVLCache, so later jobs find atlases decoded and MVLs parsed
+  # (unless their files changed)
+  def __init__(
+    self, workers=2, atlas_cache_bytes=1024 * 2**20, mvl_cache_files=256,
+    save_threads=2, keep_jobs=1000, verbose=False
+  ):
+    self.atlas_cache = undice.AtlasCache(atlas_cache_bytes, stat_files=True)
+    self.mvl_cache = MVLCache(mvl_cache_files)
+    self.save_threads = save_threads; self.keep_jobs = keep_jobs
+    self.verbose = verbose
+    self.jobs = OrderedDict(); self.next_id = 1
+    self.queue = queue.Queue(); self.lock = threading.Lock()
+    # jobs writing to the same output folder take turns, for its manifest
+    self.outfold_locks = dict()
+    self.started = time.time()
+    self.threads = [
+      threading.Thread(target=self.work, daemon=True) for _ in range(workers)
+    ]
+    for thread in self.threads:
+      thread.start()
+
+  def submit(self, request):
+    # request is the JSON body of POST /jobs: {"paths": [...], options...}
+    paths = request.get('paths')
+    if isinstance(paths, str):
+      paths = [paths]
+    if not paths or not all(isinstance(path, str) for path in paths):
+      raise ValueError('"paths" must be a path or list of paths')
+    unknown = set(request) - set(JOB_OPTIONS) - {'paths'}
+    if unknown:
+      raise ValueError(f'unknown options: {", ".join(sorted(unknown))}')
+    options = dict(JOB_OPTIONS)
+    options.update(
+      (key, request[key]) for key in JOB_OPTIONS if key in request
+    )
+    flags = ('force', 'use_unitypack', 'save_plans', 'no_optimize', 'dedupe')
+    for key in flags:
+      if not isinstance(options[key], bool):
+        raise ValueError(f'"{key}" must be true or false')
+    if not isinstance(options['output_directory'], str):
+      raise ValueError('"output_directory" must be a path')
+    if options['engine'] not in ('numpy', 'pil'):
+      raise ValueError('"engine" must be "numpy" or "pil"')
+    if isinstance(options['only'], str):
+      options['only'] = [options['only']]
+    if options['only'] is not None and (
+      not isinstance(options['only'], list) or
+      not all(isinstance(pattern, str) for pattern in options['only'])
+    ):
+      raise ValueError('"only" must be a pattern or list of patterns')
+    # bool is an int too
+    def is_int(value):
+      return isinstance(value, int) and not isinstance(value, bool)
+    png_level = options['png_level']
+    if png_level is not None and not (
+      is_int(png_level) and 0 <= png_level <= 9
+    ):
+      raise ValueError('"png_level" must be 0 to 9')
+    if not (is_int(options['bands']) and options['bands'] >= 0):
+      raise ValueError('"bands" must be a row count of 0 or more')
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+      raise ValueError(f'no such paths: {", ".join(missing)}')
+    with self.lock:
+      job = Job(str(self.next_id), paths, options); self.next_id += 1
+      self.jobs[job.id] = job
+      self.forget_old_jobs()
+    self.queue.put(job)
+    return job
+
+  def forget_old_jobs(self):
+    finished = [
+      job_id for job_id, job in self.jobs.items()
+      if job.state in ('done', 'failed', 'cancelled')
+    ]
+    for job_id in finished[:max(len(finished) - self.keep_jobs, 0)]:
+      del self.jobs[job_id]
+
+  def get(self, job_id):
+    with self.lock:
+      return self.jobs.get(job_id)
+
+  def list(self):
+    with self.lock:
+      return list(self.jobs.values())
+
+  def cancel(self, job_id):
+    # queued jobs are dropped, running ones stop after their current file
+    job = self.get(job_id)
+    if job is not None and job.state in ('queued', 'running'):
+      job.cancelling = True
+    return job
+
+  def stats(self):
+    cache = self.atlas_cache
+    with cache.lock:
+      atlas_stats = {
+        'atlases': len(cache.entries), 'mb': cache.nbytes / 2**20,
+        'max_mb': cache.max_bytes / 2**20, 'hits': cache.hits,
+        'misses': cache.misses, 'evictions': cache.evictions
+      }
+    states = dict()
+    for job in self.list():
+      states[job.state] = states.get(job.state, 0) + 1
+    return {
+      'uptime_seconds': time.time() - self.started,
+      'workers': len(self.threads), 'queued': self.queue.qsize(),
+      'jobs': states, 'atlas_cache': atlas_stats,
+      'mvl_cache': self.mvl_cache.stats()
+    }
+
+  def work(self):
+    while True:
+      job = self.queue.get()
+      if job.cancelling:
+        job.state = 'cancelled'; job.finished = time.time()
+        continue
+      job.state = 'running'; job.started = time.time()
+      if self.verbose:
+        print(f'Job {job.id} started:', ', '.join(job.paths))
+      try:
+        self.run(job)
+        job.state = 'cancelled' if job.cancelling else 'done'
+      except Exception:
+        job.error = traceback.format_exc(); job.state = 'failed'
+      job.current = None; job.finished = time.time()
+      if self.verbose:
+        print(
+          f'Job {job.id} {job.state} in {job.finished - job.started:.3f}s'
+        )
+
+  def run(self, job):
+    options = job.options
+    outfold = options['output_directory']
+    with self.lock:
+      outfold_lock = self.outfold_locks.setdefault(
+        os.path.abspath(outfold), threading.Lock()
+      )
+    writer = undice.PNGWriter(
+      self.save_threads, save_kwargs=undice.get_png_save_kwargs(
+        not options['no_optimize'], options['png_level']
+      )
+    )
+    wanted = None
+    if options['only']:
+      wanted = partial(undice.name_matches, tuple(options['only']))
+    with outfold_lock:
+      # runs picking out sprites leave the manifest be, as in undice.py
+      manifest = None if wanted else undice.Manifest(outfold)
+      # images found scanning are looked in by this job alone
+      scan_cache = undice.ScanCache(outfold); dir_images = dict()
+      infile_paths = list(
+        undice.scan_fpaths(job.paths, scan_cache, dir_images)
+      )
+      scan_cache.save()
+      job.total = len(infile_paths)
+      os.makedirs(outfold, exist_ok=True)
+      # files are undiced into staging and only then swapped for their
+      # previous outputs, as in undice.py, so failing leaves those be
+      staging_root = undice.make_staging_root(outfold)
+      try:
+        for infile_path in infile_paths:
+          if job.cancelling:
+            break
+          job.current = infile_path
+          start = time.perf_counter()
+          result = {'status': None, 'seconds': None, 'saved': 0}
+          staging = None
+          try:
+            if manifest and not options['force'] and \
+              manifest.is_current(infile_path):
+              result['status'] = 'unchanged'
+            else:
+              staging = tempfile.mkdtemp(dir=staging_root.name)
+              saved = undice.produce_undiced(
+                infile_path, staging, False, options['use_unitypack'],
+                options['engine'], self.atlas_cache, options['save_plans'],
+                writer, wanted, options['bands'], options['dedupe'],
+                self.mvl_cache, dir_images
+              )
+              inputs = None
+              if manifest:
+                inputs = undice.get_input_digests(
+                  infile_path, manifest.digests, dir_images
+                )
+              undice.settle_staged(
+                infile_path, staging, saved, outfold, manifest,
+                inputs=inputs
+              )
+              result['status'] = 'skipped' if saved is None else 'undiced'
+              result['saved'] = len(saved or ())
+          except Exception:
+            result['status'] = 'failed'
+            result['error'] = traceback.format_exc()
+          finally:
+            if staging:
+              shutil.rmtree(staging, ignore_errors=True)
+          result['seconds'] = time.perf_counter() - start
+          with job.lock:
+            job.files[infile_path] = result
+      finally:
+        writer.close()
+        staging_root.cleanup()
+        if manifest:
+          manifest.save()
+
+class ServiceHandler(BaseHTTPRequestHandler):
+  # GET /jobs, GET /jobs/<id>, POST /jobs, DELETE /jobs/<id>, GET /stats;
+  # JSON in and out
+  def send_json(self, status, body):
+    data = json.dumps(body, indent=1).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def get_job(self, parts):
+    job = self.server.service.get(parts[1]) if len(parts) == 2 else None
+    if job is None:
+      self.send_json(404, {'error': f'no job {"/".join(parts[1:])}'})
+    return job
+
+  def do_GET(self):
+    service = self.server.service
+    parts = self.path.split('?')[0].strip('/').split('/')
+    if parts == ['stats']:
+      self.send_json(200, service.stats())
+    elif parts == ['jobs']:
+      self.send_json(200, [job.as_dict(False) for job in service.list()])
+    elif parts[0] == 'jobs':
+      job = self.get_job(parts)
+      if job is not None:
+        self.send_json(200, job.as_dict())
+    else:
+      self.send_json(404, {'error': f'no such path {self.path}'})
+
+  def do_POST(self):
+    if self.path.strip('/') != 'jobs':
+      self.send_json(404, {'error': f'no such path {self.path}'})
+      return
+    try:
+      length = int(self.headers.get('Content-Length') or 0)
+      request = json.loads(self.rfile.read(length) or b'{}')
+      if not isinstance(request, dict):
+        raise ValueError('body must be a JSON object')
+      job = self.server.service.submit(request)
+    except ValueError as error: # json.JSONDecodeError is one too
+      self.send_json(400, {'error': str(error)})
+      return
+    self.send_json(202, job.as_dict(False))
+
+  def do_DELETE(self):
+    parts = self.path.strip('/').split('/')
+    if parts[0] != 'jobs':
+      self.send_json(404, {'error': f'no such path {self.path}'})
+      return
+    job = self.get_job(parts)
+    if job is not None:
+      self.server.service.cancel(job.id)
+      self.send_json(200, job.as_dict(False))
+
+  def log_message(self, format, *args):
+    if self.server.service.verbose:
+      super().log_message(format, *args)
+
+if __name__ == '__main__':
+  args = _init_parser().parse_args(sys.argv[1:])
+  service = Service(
+    args.workers, args.atlas_cache_mb * 2**20, args.mvl_cache_files,
+    args.save_threads, args.keep_jobs, args.verbose
+  )
+  server = ThreadingHTTPServer((args.host, args.port), ServiceHandler)
+  server.service = service
+  print(f'Undice service on http://{args.host}:{server.server_port}/')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
@@ -0,0 +1,535 @@
+import os
+import lzma
+from bisect import bisect_right
+from collections import OrderedDict
+from functools import partial
+from struct import Struct, unpack_from
+
+import numpy as np
+from PIL import Image
+
+from undice_profile import stage
+
+try:
+  import lz4.block
+except ImportError: # pure python fallback below
+  lz4 = None
+
+# reads DicingTextures straight out of UnityFS assetbundles: blocks are only
+# decompressed as the objects in them are read, objects are picked out of
+# each serialized file's index by type, and only DicingTextures
+# MonoBehaviours and the Texture2D atlases they name are deserialized
+
+## decompression
+def lz4_block_decompress(data, size):
+  if lz4 is not None:
+    return lz4.block.decompress(data, uncompressed_size=size)
+  out = bytearray(); n = 0; end = len(data)
+  while n < end:
+    token = data[n]; n += 1
+    length = token >> 4
+    if length == 15:
+      while True:
+        extra = data[n]; n += 1; length += extra
+        if extra != 255:
+          break
+    out += data[n:n+length]; n += length
+    if n >= end: # last sequence is literals only
+      break
+    offset = data[n] | data[n+1] << 8; n += 2
+    length = token & 15
+    if length == 15:
+      while True:
+        extra = data[n]; n += 1; length += extra
+        if extra != 255:
+          break
+    length += 4
+    if not 0 < offset <= len(out):
+      raise ValueError(f'LZ4 match offset {offset} out of range!')
+    start = len(out) - offset
+    if offset >= length:
+      out += out[start:start+length]
+    else: # match overlaps what it's copying, so repeats it
+      out += (out[start:] * (length // offset + 1))[:length]
+  if len(out) != size:
+    raise ValueError(f'LZ4 block gave {len(out)} bytes, expected {size}!')
+  return bytes(out)
+
+def lzma_decompress(data, size):
+  # Unity's LZMA: 5 byte properties then a raw LZMA1 stream
+  props = data[0]
+  lc = props % 9; props //= 9; lp = props % 5; pb = props // 5
+  decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[{
+    'id': lzma.FILTER_LZMA1, 'dict_size': unpack_from('<I', data, 1)[0],
+    'lc': lc, 'lp': lp, 'pb': pb
+  }])
+  return decompressor.decompress(data[5:], size)
+
+def decompress(data, size, compression):
+  if compression == 0:
+    return data
+  elif compression == 1:
+    return lzma_decompress(data, size)
+  elif compression in (2, 3): # LZ4, LZ4HC
+    return lz4_block_decompress(data, size)
+  raise NotImplementedError(f'Unknown compression type {compression}!')
+
+## binary reading
+class Reader:
+  def __init__(self, data, pos=0, endian='>'):
+    self.data = data; self.pos = pos; self.endian = endian
+    self.structs = dict()
+
+  def unpack(self, fmt):
+    key = self.endian + fmt
+    if not key in self.structs:
+      self.structs[key] = Struct(key)
+    values = self.structs[key].unpack_from(self.data, self.pos)
+    self.pos += self.structs[key].size
+    return values if len(values) > 1 else values[0]
+
+  def unpack_array(self, fmt, count):
+    return list(self.unpack(f'{count}{fmt}')) if count > 1 else \
+      [self.unpack(fmt) for _ in range(count)]
+
+  def read(self, size):
+    data = self.data[self.pos:self.pos+size]
+    if len(data) != size:
+      raise EOFError(f'wanted {size} bytes at {self.pos}, got {len(data)}')
+    self.pos += size
+    return bytes(data)
+
+  def read_cstring(self):
+    end = self.data.index(b'\x00', self.pos)
+    text = bytes(self.data[self.pos:end]).decode('utf8', 'surrogateescape')
+    self.pos = end + 1
+    return text
+
+  def align(self, size=4):
+    self.pos += -self.pos % size
+
+## bundles
+class BlockStream:
+  # the bundle's data blocks as one uncompressed stream, decompressing only
+  # the blocks a read touches and keeping the last few
+  def __init__(self, f, data_start, blocks, cached=4):
+    self.f = f; self.blocks = blocks; self.cached = cached
+    self.cache = OrderedDict()
+    # (uncompressed start, compressed start) of each block
+    self.starts = list(); self.positions = list()
+    start = 0; position = data_start
+    for size, compressed_size, flags in blocks:
+      self.starts.append(start); self.positions.append(position)
+      start += size; position += compressed_size
+    self.size = start
+
+  def get_block(self, n):
+    if n in self.cache:
+      self.cache.move_to_end(n)
+      return self.cache[n]
+    size, compressed_size, flags = self.blocks[n]
+    self.f.seek(self.positions[n])
+    block = decompress(self.f.read(compressed_size), size, flags & 0x3F)
+    self.cache[n] = block
+    if len(self.cache) > self.cached:
+      self.cache.popitem(last=False)
+    return block
+
+  def read(self, offset, size):
+    if offset < 0 or offset + size > self.size:
+      raise EOFError(f'{size} bytes at {offset} past end of bundle data')
+    chunks = list()
+    n = bisect_right(self.starts, offset) - 1
+    while size > 0:
+      block = self.get_block(n)
+      inner = offset - self.starts[n]
+      chunk = block[inner:inner+size]
+      if not chunk:
+        raise EOFError(f'block {n} shorter than its listed size')
+      chunks.append(chunk); offset += len(chunk); size -= len(chunk); n += 1
+    return b''.join(chunks)
+
+class Bundle:
+  def __init__(self, f):
+    self.f = f
+    f.seek(0, os.SEEK_END); file_size = f.tell(); f.seek(0)
+    header = Reader(f.read(min(file_size, 4096)))
+    signature = header.read_cstring()
+    if signature != 'UnityFS':
+      raise ValueError(f'{f.name} is {signature!r}, not a UnityFS bundle!')
+    self.version = header.unpack('I')
+    self.unity_version = header.read_cstring()
+    self.unity_revision = header.read_cstring()
+    size, compressed_size, uncompressed_size, flags = header.unpack('qIII')
+    if self.version >= 7 or _get_major_minor(self.unity_revision) >= \
+      (2019, 4) and not header.data[header.pos:header.pos + -header.pos % 16] \
+      .strip(b'\x00'):
+      # some 2019.4+ version 6 bundles are padded too
+      header.align(16)
+    if flags & 0x80: # blocks info at the end
+      f.seek(file_size - compressed_size)
+      data_start = header.pos
+    else:
+      f.seek(header.pos)
+      data_start = header.pos + compressed_size
+    info = Reader(decompress(
+      f.read(compressed_size), uncompressed_size, flags & 0x3F
+    ))
+    info.read(16) # uncompressed data hash
+    blocks = [info.unpack('IIH') for _ in range(info.unpack('i'))]
+    self.nodes = list()
+    for _ in range(info.unpack('i')):
+      offset, size, node_flags = info.unpack('qqI')
+      self.nodes.append((info.read_cstring(), offset, size, node_flags))
+    if flags & 0x200: # block data needs padding at start
+      data_start += -data_start % 16
+    self.stream = BlockStream(f, data_start, blocks)
+
+  def read_node(self, node, offset=0, size=None):
+    path, node_offset, node_size, flags = node
+    if size is None:
+      size = node_size - offset
+    if offset + size > node_size:
+      raise EOFError(f'{size} bytes at {offset} past end of {path}')
+    return self.stream.read(node_offset + offset, size)
+
+  def get_node(self, path):
+    # path as in Texture2D stream data, e.g. "archive:/CAB-x/CAB-x.resS"
+    for node in self.nodes:
+      if node[0] == path or node[0] == path.split('/')[-1]:
+        return node
+    raise FileNotFoundError(f'{path} not in bundle {self.f.name}!')
+
+  def iter_serialized_files(self):
+    nodes = [node for node in self.nodes if node[3] & 4]
+    if not nodes: # not flagged; resources hold raw texture or audio data
+      nodes = [
+        node for node in self.nodes
+        if not os.path.splitext(node[0])[1] in ('.resS', '.resource')
+      ]
+    for node in nodes:
+      yield SerializedFile(self, node)
+
+def _get_major_minor(unity_revision):
+  # e.g. (2019, 4) from "2019.4.15f1"
+  try:
+    return tuple(int(part) for part in unity_revision.split('.')[:2])
+  except ValueError:
+    return (0, 0)
+
+## serialized files
+# strings type trees refer to by offset into Unity's own common buffer
+COMMON_STRINGS = b'\x00'.join(name.encode() for name in (
+  'AABB', 'AnimationClip', 'AnimationCurve', 'AnimationState', 'Array',
+  'Base', 'BitField', 'bitset', 'bool', 'char', 'ColorRGBA', 'Component',
+  'data', 'deque', 'double', 'dynamic_array', 'FastPropertyName', 'first',
+  'float', 'Font', 'GameObject', 'Generic Mono', 'GradientNEW', 'GUID',
+  'GUIStyle', 'int', 'list', 'long long', 'map', 'Matrix4x4f', 'MdFour',
+  'MonoBehaviour', 'MonoScript', 'm_ByteSize', 'm_Curve',
+  'm_EditorClassIdentifier', 'm_EditorHideFlags', 'm_Enabled',
+  'm_ExtensionPtr', 'm_GameObject', 'm_Index', 'm_IsArray', 'm_IsStatic',
+  'm_MetaFlag', 'm_Name', 'm_ObjectHideFlags', 'm_PrefabInternal',
+  'm_PrefabParentObject', 'm_Script', 'm_StaticEditorFlags', 'm_Type',
+  'm_Version', 'Object', 'pair', 'PPtr<Component>', 'PPtr<GameObject>',
+  'PPtr<Material>', 'PPtr<MonoBehaviour>', 'PPtr<MonoScript>',
+  'PPtr<Object>', 'PPtr<Prefab>', 'PPtr<Sprite>', 'PPtr<TextAsset>',
+  'PPtr<Texture>', 'PPtr<Texture2D>', 'PPtr<Transform>', 'Prefab',
+  'Quaternionf', 'Rectf', 'RectInt', 'RectOffset', 'second', 'set', 'short',
+  'size', 'SInt16', 'SInt32', 'SInt64', 'SInt8', 'staticvector', 'string',
+  'TextAsset', 'TextMesh', 'Texture', 'Texture2D', 'Transform',
+  'TypelessData', 'UInt16', 'UInt32', 'UInt64', 'UInt8', 'unsigned int',
+  'unsigned long long', 'unsigned short', 'vector', 'Vector2f', 'Vector3f',
+  'Vector4f', 'm_ScriptingClassIdentifier', 'Gradient', 'Type*',
+  'int2_storage', 'int3_storage', 'BoundsInt', 'm_CorrespondingSourceObject',
+  'm_PrefabInstance', 'm_PrefabAsset', 'FileSize', 'Hash128'
+)) + b'\x00'
+
+PRIMITIVES = {
+  'bool': '?', 'char': 'B', 'SInt8': 'b', 'UInt8': 'B', 'short': 'h',
+  'SInt16': 'h', 'unsigned short': 'H', 'UInt16': 'H', 'int': 'i',
+  'SInt32': 'i', 'unsigned int': 'I', 'UInt32': 'I', 'Type*': 'I',
+  'long long': 'q', 'SInt64': 'q', 'unsigned long long': 'Q', 'UInt64': 'Q',
+  'FileSize': 'Q', 'float': 'f', 'double': 'd'
+}
+
+CLASS_MONOBEHAVIOUR = 114; CLASS_TEXTURE2D = 28
+
+class TypeNode:
+  def __init__(self, type, name, level, flags, meta_flag):
+    self.type = type; self.name = name; self.level = level
+    self.is_array = bool(flags & 1) or type == 'Array'
+    self.meta_flag = meta_flag
+    self.children = list()
+
+def _nest_type_nodes(nodes):
+  # flat depth-first node list into a tree, returning the root
+  parents = list()
+  for node in nodes:
+    del parents[node.level:]
+    if parents:
+      parents[-1].children.append(node)
+    parents.append(node)
+  return nodes[0]
+
+class SerializedFile:
+  def __init__(self, bundle, node):
+    self.bundle = bundle; self.node = node; self.name = node[0]
+    head = Reader(bundle.read_node(node, 0, min(48, node[2])))
+    metadata_size, file_size, self.version, self.data_offset = \
+      head.unpack('IIII')
+    if not 9 <= self.version < 100:
+      raise ValueError(
+        f'{self.name} serialized file version {self.version} not supported'
+      )
+    endian = head.unpack('B'); head.read(3)
+    if self.version >= 22:
+      metadata_size, file_size, self.data_offset = head.unpack('Iqq')
+      head.read(8)
+    self.endian = '<' if endian == 0 else '>'
+    reader = Reader(
+      bundle.read_node(node, 0, head.pos + metadata_size), head.pos,
+      self.endian
+    )
+    if self.version >= 7:
+      self.unity_version = reader.read_cstring()
+    if self.version >= 8:
+      self.platform = reader.unpack('i')
+    self.type_trees = self.version < 13 or reader.unpack('?')
+    self.types = [self._read_type(reader) for _ in range(reader.unpack('i'))]
+    big_ids = 7 <= self.version < 14 and reader.unpack('i')
+    # path id: (class id, type tree root, byte start, byte size)
+    self.objects = dict()
+    for _ in range(reader.unpack('i')):
+      if big_ids:
+        path_id = reader.unpack('q')
+      elif self.version < 14:
+        path_id = reader.unpack('i')
+      else:
+        reader.align(4); path_id = reader.unpack('q')
+      start = reader.unpack('q' if self.version >= 22 else 'I')
+      size, type_id = reader.unpack('Ii')
+      if self.version < 16:
+        class_id = reader.unpack('H')
+        type = next(
+          (type for type in self.types if type[0] == type_id), (class_id, None)
+        )
+      else:
+        type = self.types[type_id]; class_id = type[0]
+      if self.version < 11:
+        reader.read(2)
+      if 11 <= self.version < 17:
+        reader.read(2)
+      if self.version in (15, 16):
+        reader.read(1)
+      self.objects[path_id] = (
+        class_id, type[1], self.data_offset + start, size
+      )
+
+  def _read_type(self, reader):
+    # (class id, type tree root or None)
+    class_id = reader.unpack('i')
+    if self.version >= 16:
+      reader.read(1) # stripped
+    if self.version >= 17:
+      reader.read(2) # script type index
+    if self.version >= 13:
+      if self.version < 16 and class_id < 0 or \
+        self.version >= 16 and class_id == CLASS_MONOBEHAVIOUR:
+        reader.read(16) # script id
+      reader.read(16) # old type hash
+    root = None
+    if self.type_trees:
+      if self.version >= 12 or self.version == 10:
+        root = self._read_type_tree_blob(reader)
+      else:
+        root = _nest_type_nodes(self._read_type_tree(reader, 0))
+      if self.version >= 21:
+        reader.read(4 * reader.unpack('i')) # type dependencies
+    return class_id, root
+
+  def _read_type_tree_blob(self, reader):
+    node_count, strings_size = reader.unpack('ii')
+    fields = [
+      reader.unpack('HBBIIiii' + ('Q' if self.version >= 19 else ''))
+      for _ in range(node_count)
+    ]
+    strings = reader.read(strings_size)
+    def get_string(offset):
+      buffer = strings
+      if offset & 0x80000000:
+        buffer = COMMON_STRINGS; offset &= 0x7FFFFFFF
+      return buffer[offset:buffer.index(b'\x00', offset)].decode()
+    return _nest_type_nodes([
+      TypeNode(
+        get_string(field[3]), get_string(field[4]), field[1], field[2],
+        field[7]
+      ) for field in fields
+    ])
+
+  def _read_type_tree(self, reader, level):
+    # before the blob format: each node followed by its children
+    type = reader.read_cstring(); name = reader.read_cstring()
+    reader.unpack('i') # byte size
+    if self.version == 2:
+      reader.unpack('i')
+    if self.version != 3:
+      reader.unpack('i') # index
+    flags = reader.unpack('i'); reader.unpack('i') # version
+    meta_flag = reader.unpack('i') if self.version != 3 else 0
+    nodes = [TypeNode(type, name, level, flags, meta_flag)]
+    for _ in range(reader.unpack('i')):
+      nodes += self._read_type_tree(reader, level + 1)
+    return nodes
+
+  def read_object_data(self, path_id):
+    class_id, root, start, size = self.objects[path_id]
+    return self.bundle.read_node(self.node, start, size)
+
+  def read_object(self, path_id):
+    root = self.objects[path_id][1]
+    if root is None:
+      raise NotImplementedError(
+        f'{self.name} was built without type trees, so its objects can\'t '
+        'be read; export them with AssetStudio instead'
+      )
+    reader = Reader(self.read_object_data(path_id), 0, self.endian)
+    return read_type_tree_value(root, reader)
+
+  def read_name(self, path_id):
+    # m_Name alone, which comes first in named objects
+    root = self.objects[path_id][1]
+    if root is None or not root.children or \
+      root.children[0].name != 'm_Name':
+      return self.read_object(path_id).get('m_Name')
+    class_id, root, start, size = self.objects[path_id]
+    length = unpack_from(
+      self.endian + 'i', self.bundle.read_node(self.node, start, 4)
+    )[0]
+    return self.bundle.read_node(self.node, start + 4, length).decode(
+      'utf8', 'surrogateescape'
+    )
+
+def read_type_tree_value(node, reader):
+  if node.type in PRIMITIVES:
+    value = reader.unpack(PRIMITIVES[node.type])
+  elif node.type == 'string':
+    value = reader.read(reader.unpack('i')).decode('utf8', 'surrogateescape')
+    if node.children and node.children[0].meta_flag & 0x4000:
+      reader.align(4)
+  elif node.type == 'TypelessData':
+    value = reader.read(reader.unpack('i'))
+  elif node.is_array:
+    count = reader.unpack('i'); item = node.children[1]
+    if item.type in PRIMITIVES and not item.meta_flag & 0x4000:
+      value = reader.unpack_array(PRIMITIVES[item.type], count)
+    else:
+      value = [read_type_tree_value(item, reader) for _ in range(count)]
+  elif node.children and node.children[0].is_array:
+    # vector, map, set and the like wrap their array
+    value = read_type_tree_value(node.children[0], reader)
+  else:
+    value = {
+      child.name: read_type_tree_value(child, reader)
+      for child in node.children
+    }
+  if node.meta_flag & 0x4000:
+    reader.align(4)
+  return value
+
+## textures
+# m_TextureFormat: (mode, decoder, decoder args, block size, block bytes)
+TEXTURE_FORMATS = {
+  1: ('L', 'raw', 'L', 1, 1), # Alpha8
+  3: ('RGB', 'raw', 'RGB', 1, 3), # RGB24
+  4: ('RGBA', 'raw', 'RGBA', 1, 4), # RGBA32
+  5: ('RGBA', 'raw', 'ARGB', 1, 4), # ARGB32
+  7: ('RGB', 'raw', 'BGR;16', 1, 2), # RGB565, red in the high bits
+  10: ('RGBA', 'bcn', 1, 4, 8), # DXT1
+  12: ('RGBA', 'bcn', 3, 4, 16), # DXT5
+  14: ('RGBA', 'raw', 'BGRA', 1, 4), # BGRA32
+  25: ('RGBA', 'bcn', 7, 4, 16), # BC7
+  26: ('L', 'bcn', 4, 4, 8), # BC4
+  27: ('RGB', 'bcn', 5, 4, 16), # BC5
+  63: ('L', 'raw', 'L', 1, 1) # R8
+}
+# 16 bit formats unpacked by hand: channel shifts in R, G, B, A order
+TEXTURE_FORMATS_4444 = {2: (8, 4, 0, 12), 13: (12, 8, 4, 0)}
+
+def decode_texture(data, width, height, texture_format):
+  # PILimg the right way up (Unity stores rows bottom first) of the first
+  # mip level in data
+  if texture_format in TEXTURE_FORMATS_4444:
+    pixels = np.frombuffer(data, '<u2', width * height).reshape(height, width)
+    im = Image.fromarray(np.stack([
+      ((pixels >> shift) & 15).astype(np.uint8) * 17
+      for shift in TEXTURE_FORMATS_4444[texture_format]
+    ], axis=-1), 'RGBA')
+  elif texture_format in TEXTURE_FORMATS:
+    mode, decoder, args, block, block_bytes = TEXTURE_FORMATS[texture_format]
+    across = -(-width // block); down = -(-height // block)
+    im = Image.frombytes(
+      mode, (across * block, down * block),
+      data[:across * down * block_bytes], decoder, args
+    )
+    if im.size != (width, height):
+      im = im.crop((0, 0, width, height))
+    if texture_format == 1:
+      alpha = im; im = Image.new('RGBA', im.size, (255, 255, 255, 0))
+      im.putalpha(alpha)
+    elif texture_format == 63:
+      blank = Image.new('L', im.size)
+      im = Image.merge('RGB', (im, blank, blank))
+  else:
+    raise NotImplementedError(
+      f'Texture format {texture_format} not supported; export the atlas '
+      'with AssetStudio instead'
+    )
+  return im.transpose(Image.FLIP_TOP_BOTTOM)
+
+def read_texture2d(serialized, path_id):
+  with stage('decode') as counts:
+    texture = serialized.read_object(path_id)
+    data = texture.get('image data', b'')
+    stream = texture.get('m_StreamData')
+    if not data and stream and stream.get('path'):
+      bundle = serialized.bundle
+      data = bundle.read_node(
+        bundle.get_node(stream['path']), stream['offset'], stream['size']
+      )
+    counts['bytes_in'] = len(data)
+    counts['pixels'] = texture['m_Width'] * texture['m_Height']
+    return decode_texture(
+      data, texture['m_Width'], texture['m_Height'],
+      texture['m_TextureFormat']
+    )
+
+## dicings
+def is_dicing_type(root):
+  fields = set(child.name for child in root.children)
+  return {'cellSize', 'padding', 'textureDataList'} <= fields
+
+def get_dicentex_from_bundle(f):
+  # (dicings, textures) as get_dicentex_from_assetbundle in undice.py gives
+  # them: DicingTextures MonoBehaviours read as dicts, and callables keyed by
+  # texture name decoding the Texture2D atlases the dicings name when called
+  bundle = Bundle(f)
+  # path ids are only unique within one serialized file
+  dicings = list(); texture_ids = list()
+  for serialized in bundle.iter_serialized_files():
+    for path_id, (class_id, root, start, size) in \
+      serialized.objects.items():
+      if class_id == CLASS_MONOBEHAVIOUR and root is not None and \
+        is_dicing_type(root):
+        dicings.append(serialized.read_object(path_id))
+      elif class_id == CLASS_TEXTURE2D:
+        texture_ids.append((serialized, path_id))
+  wanted = set(
+    textureData['atlasName'] for dicing in dicings
+    for textureData in dicing['textureDataList']
+  )
+  textures = dict()
+  for serialized, path_id in texture_ids:
+    name = serialized.read_name(path_id)
+    if name in wanted:
+      textures[name] = partial(read_texture2d, serialized, path_id)
+  return dicings, textures
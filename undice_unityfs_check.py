@@ -0,0 +1,395 @@
+import os
+import sys
+import lzma
+import argparse
+import tempfile
+from struct import pack, pack_into
+
+import numpy as np
+
+import undice_unityfs
+from undice_benchmark import make_atlas, make_dicing
+from undice_unityfs import COMMON_STRINGS, PRIMITIVES
+
+def _init_parser():
+  description = (
+    "Writes synthetic UnityFS bundles in each layout undice_unityfs reads "
+    "(serialized file versions, LZMA/LZ4/no compression, big endian, "
+    "textures streamed from .resS, several serialized files) and checks the "
+    "DicingTextures and atlases read back match what was written."
+  )
+  parser = argparse.ArgumentParser(description=description)
+  parser.add_argument(
+    '-k', '--keep', type=str,
+    help='folder to keep the generated bundles in (default: delete them)'
+  )
+  parser.add_argument(
+    '--seed', type=int, default=0, help='random seed (default 0)'
+  )
+  return parser
+
+## compression
+def lz4_block_compress(data):
+  # greedy LZ4 block matching on 4 byte prefixes; slow but valid
+  out = bytearray(); end = len(data); n = 0; anchor = 0; last_seen = dict()
+  def put_length(length):
+    while length >= 255:
+      out.append(255); length -= 255
+    out.append(length)
+  def emit(literals, match_length=None, distance=None):
+    token = min(len(literals), 15) << 4
+    if match_length is not None:
+      token |= min(match_length - 4, 15)
+    out.append(token)
+    if len(literals) >= 15:
+      put_length(len(literals) - 15)
+    out.extend(literals)
+    if match_length is not None:
+      out.extend(pack('<H', distance))
+      if match_length - 4 >= 15:
+        put_length(match_length - 4 - 15)
+  # the last match has to start 12 bytes and end 5 bytes before the end
+  while n + 12 < end:
+    prefix = data[n:n + 4]; seen = last_seen.get(prefix)
+    last_seen[prefix] = n
+    if seen is not None and n - seen < 65536:
+      length = 4
+      while n + length < end - 5 and data[seen + length] == data[n + length]:
+        length += 1
+      emit(data[anchor:n], length, n - seen)
+      n += length; anchor = n
+    else:
+      n += 1
+  emit(data[anchor:])
+  return bytes(out)
+
+def lzma_compress(data):
+  # raw LZMA1 behind Unity's 5 byte properties header, no size field
+  lc, lp, pb, dict_size = 3, 0, 2, 1 << 20
+  raw = lzma.compress(data, format=lzma.FORMAT_RAW, filters=[{
+    'id': lzma.FILTER_LZMA1, 'dict_size': dict_size,
+    'lc': lc, 'lp': lp, 'pb': pb
+  }])
+  return bytes([(pb * 5 + lp) * 9 + lc]) + pack('<I', dict_size) + raw
+
+def compress(data, compression):
+  # compression as in bundle flags: 0 none, 1 LZMA, 2 LZ4, 3 LZ4HC
+  if compression == 0:
+    return data
+  if compression == 1:
+    return lzma_compress(data)
+  return lz4_block_compress(data)
+
+## type trees
+# (level, type, name, flags, meta flag); meta flag 0x4000 aligns after
+def string_nodes(level, name):
+  return [
+    (level, 'string', name, 0, 0), (level + 1, 'Array', 'Array', 1, 0x4000),
+    (level + 2, 'int', 'size', 0, 0), (level + 2, 'char', 'data', 0, 0)
+  ]
+
+def pptr_nodes(level, type, name):
+  return [
+    (level, type, name, 0, 0), (level + 1, 'int', 'm_FileID', 0, 0),
+    (level + 1, 'SInt64', 'm_PathID', 0, 0)
+  ]
+
+def vector_nodes(level, name, type):
+  return [
+    (level, 'vector', name, 0, 0), (level + 1, 'Array', 'Array', 1, 0),
+    (level + 2, 'int', 'size', 0, 0), (level + 2, type, 'data', 0, 0)
+  ]
+
+MONOBEHAVIOUR_NODES = [(0, 'MonoBehaviour', 'Base', 0, 0)] + \
+  pptr_nodes(1, 'PPtr<GameObject>', 'm_GameObject') + \
+  [(1, 'UInt8', 'm_Enabled', 0, 0x4000)] + \
+  pptr_nodes(1, 'PPtr<MonoScript>', 'm_Script') + string_nodes(1, 'm_Name')
+DICING_NODES = MONOBEHAVIOUR_NODES + [
+  (1, 'int', 'cellSize', 0, 0), (1, 'int', 'padding', 0, 0)
+] + vector_nodes(1, 'textureDataList', 'DicingTextureData') + \
+  string_nodes(4, 'name') + string_nodes(4, 'atlasName') + [
+  (4, 'int', 'width', 0, 0), (4, 'int', 'height', 0, 0)
+] + vector_nodes(4, 'cellIndexList', 'int')
+# any other script, which must be skipped without being read
+OTHER_NODES = MONOBEHAVIOUR_NODES + [
+  (1, 'float', 'speed', 0, 0), (1, 'bool', 'flag', 0, 0x4000)
+]
+TEXTURE_NODES = [(0, 'Texture2D', 'Base', 0, 0)] + \
+  string_nodes(1, 'm_Name') + [
+  (1, 'int', 'm_ForcedFallbackFormat', 0, 0),
+  (1, 'bool', 'm_DownscaleFallback', 0, 0x4000),
+  (1, 'int', 'm_Width', 0, 0), (1, 'int', 'm_Height', 0, 0),
+  (1, 'int', 'm_CompleteImageSize', 0, 0),
+  (1, 'int', 'm_TextureFormat', 0, 0), (1, 'int', 'm_MipCount', 0, 0),
+  (1, 'bool', 'm_IsReadable', 0, 0x4000),
+  (1, 'TypelessData', 'image data', 0, 0x4000), (2, 'int', 'size', 0, 0),
+  (2, 'UInt8', 'data', 0, 0), (1, 'StreamingInfo', 'm_StreamData', 0, 0),
+  (2, 'UInt64', 'offset', 0, 0), (2, 'unsigned int', 'size', 0, 0)
+] + string_nodes(2, 'path')
+
+def nest_nodes(nodes):
+  # root dict with each node's children under 'children'
+  parents = list(); root = None
+  for level, type, name, flags, meta_flag in nodes:
+    node = {
+      'type': type, 'name': name, 'flags': flags, 'meta_flag': meta_flag,
+      'children': list()
+    }
+    del parents[level:]
+    if parents:
+      parents[-1]['children'].append(node)
+    else:
+      root = node
+    parents.append(node)
+  return root
+
+def write_value(node, value, out, endian):
+  type = node['type']
+  if type in PRIMITIVES:
+    out += pack(endian + PRIMITIVES[type], value)
+  elif type == 'string':
+    data = value.encode()
+    out += pack(endian + 'i', len(data)) + data
+    out += bytes(-len(out) % 4)
+  elif type == 'TypelessData':
+    out += pack(endian + 'i', len(value)) + value
+  elif node['flags'] & 1:
+    out += pack(endian + 'i', len(value))
+    for item in value:
+      write_value(node['children'][1], item, out, endian)
+  elif node['children'] and node['children'][0]['flags'] & 1:
+    write_value(node['children'][0], value, out, endian)
+  else:
+    for child in node['children']:
+      write_value(child, value[child['name']], out, endian)
+  if node['meta_flag'] & 0x4000:
+    out += bytes(-len(out) % 4)
+
+def type_tree_blob(nodes, version, endian):
+  strings = bytearray(); offsets = dict()
+  def get_offset(text):
+    common = COMMON_STRINGS.find(text.encode() + b'\x00')
+    if common == 0 or common > 0 and COMMON_STRINGS[common - 1] == 0:
+      return common | 0x80000000
+    if text not in offsets:
+      offsets[text] = len(strings); strings.extend(text.encode() + b'\x00')
+    return offsets[text]
+  out = bytearray()
+  for n, (level, type, name, flags, meta_flag) in enumerate(nodes):
+    out += pack(
+      endian + 'HBBIIiii', 1, level, flags, get_offset(type), get_offset(name),
+      -1, n, meta_flag
+    )
+    if version >= 19: # type hashes
+      out += bytes(8)
+  return pack(endian + 'ii', len(nodes), len(strings)) + out + strings
+
+## bundle writing
+def make_serialized(version, endian, objects):
+  # serialized file of objects as (path id, class id, type nodes, value)
+  types = list()
+  for _, class_id, nodes, _ in objects:
+    if (class_id, nodes) not in types:
+      types.append((class_id, nodes))
+  metadata = bytearray(b'2019.4.1f1\x00' + pack(endian + 'i', 5) + b'\x01')
+  metadata += pack(endian + 'i', len(types))
+  for class_id, nodes in types:
+    is_script = class_id == undice_unityfs.CLASS_MONOBEHAVIOUR
+    metadata += pack(endian + 'i?h', class_id, False, 0 if is_script else -1)
+    if is_script: # script id
+      metadata += bytes(16)
+    metadata += bytes(16) + type_tree_blob(nodes, version, endian)
+    if version >= 21: # type dependencies
+      metadata += pack(endian + 'i', 0)
+  datas = list()
+  for _, _, nodes, value in objects:
+    out = bytearray(); write_value(nest_nodes(nodes), value, out, endian)
+    datas.append(bytes(out))
+  header_size = 48 if version >= 22 else 20
+  metadata += pack(endian + 'i', len(objects))
+  body = bytearray()
+  for (path_id, class_id, nodes, _), data in zip(objects, datas):
+    metadata += bytes(-(header_size + len(metadata)) % 4)
+    metadata += pack(
+      endian + ('qq' if version >= 22 else 'qI') + 'Ii', path_id, len(body),
+      len(data), types.index((class_id, nodes))
+    )
+    body += data + bytes(-len(data) % 8)
+  # script types, externals and ref types, then the user information string
+  metadata += pack(endian + 'ii', 0, 0)
+  if version >= 20:
+    metadata += pack(endian + 'i', 0)
+  metadata += b'\x00'
+  data_offset = header_size + len(metadata); data_offset += -data_offset % 16
+  file_size = data_offset + len(body); big_endian = endian == '>'
+  if version >= 22:
+    header = pack('>4I?3x', 0, 0, version, 0, big_endian) + \
+      pack('>Iqqq', len(metadata), file_size, data_offset, 0)
+  else:
+    header = pack(
+      '>4I?3x', len(metadata), file_size, version, data_offset, big_endian
+    )
+  return header + metadata + bytes(data_offset - len(header) - len(metadata)) \
+    + body
+
+def make_bundle(
+  nodes, version, info_compression, data_compression, info_at_end=False,
+  padded=False, block_size=1 << 12
+):
+  # UnityFS bundle of nodes as (path, data, flags)
+  data = b''.join(node_data for _, node_data, _ in nodes)
+  blocks = list(); block_datas = list()
+  for start in range(0, len(data), block_size):
+    block = data[start:start + block_size]
+    compressed = compress(block, data_compression)
+    blocks.append((len(block), len(compressed), data_compression))
+    block_datas.append(compressed)
+  info = bytearray(bytes(16) + pack('>i', len(blocks)))
+  for block in blocks:
+    info += pack('>IIH', *block)
+  info += pack('>i', len(nodes)); offset = 0
+  for path, node_data, flags in nodes:
+    info += pack('>qqI', offset, len(node_data), flags)
+    info += path.encode() + b'\x00'
+    offset += len(node_data)
+  compressed_info = compress(bytes(info), info_compression)
+  flags = info_compression | 0x40 | info_at_end * 0x80 | padded * 0x200
+  out = bytearray(b'UnityFS\x00' + pack('>I', version))
+  out += b'5.x.x\x00' + b'2019.4.1f1\x00'
+  size_at = len(out)
+  out += pack('>qIII', 0, len(compressed_info), len(info), flags)
+  if version >= 7:
+    out += bytes(-len(out) % 16)
+  if not info_at_end:
+    out += compressed_info
+  if padded:
+    out += bytes(-len(out) % 16)
+  out += b''.join(block_datas)
+  if info_at_end:
+    out += compressed_info
+  pack_into('>q', out, size_at, len(out))
+  return bytes(out)
+
+def get_texture_data(atlas, texture_format):
+  # first mip level bytes, rows bottom first as Unity stores them
+  pixels = np.asarray(atlas)[::-1]
+  channels = {3: [0, 1, 2], 4: [0, 1, 2, 3], 5: [3, 0, 1, 2], 14: [2, 1, 0, 3]}
+  return np.ascontiguousarray(pixels[..., channels[texture_format]]).tobytes()
+
+def make_texture(name, atlas, texture_format, data, stream=None):
+  # Texture2D value holding data, or pointing at stream as (path, offset)
+  texture = {
+    'm_Name': name, 'm_ForcedFallbackFormat': 4, 'm_DownscaleFallback': False,
+    'm_Width': atlas.size[0], 'm_Height': atlas.size[1],
+    'm_CompleteImageSize': len(data), 'm_TextureFormat': texture_format,
+    'm_MipCount': 1, 'm_IsReadable': False, 'image data': data,
+    'm_StreamData': {'offset': 0, 'size': 0, 'path': ''}
+  }
+  if stream is not None:
+    texture['image data'] = b''
+    texture['m_StreamData'] = {
+      'offset': stream[1], 'size': len(data), 'path': stream[0]
+    }
+  return texture
+
+def make_dicing_value(dicing):
+  return {
+    'm_GameObject': {'m_FileID': 0, 'm_PathID': 0}, 'm_Enabled': 1,
+    'm_Script': {'m_FileID': 1, 'm_PathID': 99}, 'm_Name': 'dicing',
+    **dicing
+  }
+
+## checking
+# name: (serialized file version, endian, bundle version, info compression,
+#   data compression, info at end, padded, streamed, texture formats, CABs)
+LAYOUTS = {
+  'v17_lz4': (17, '<', 6, 2, 2, False, False, False, (4, 3), 1),
+  'v21_lzma_streamed': (21, '<', 7, 1, 1, True, False, True, (5, 14), 1),
+  'v22_big_endian': (22, '>', 8, 0, 0, False, True, False, (4, 3), 1),
+  'v19_lz4hc_streamed': (19, '<', 7, 3, 2, False, True, True, (14, 4), 1),
+  'v21_two_cabs': (21, '<', 7, 2, 2, False, False, True, (4, 5), 2)
+}
+
+def make_layout(rng, layout):
+  # (bundle bytes, expected dicings, expected atlases by name)
+  version, endian, bundle_version, info_compression, data_compression, \
+    info_at_end, padded, streamed, texture_formats, cabs = layout
+  nodes = list(); dicings = list(); atlases = dict()
+  for n in range(cabs):
+    cab = f'CAB-{n:016x}'; stream_path = f'archive:/{cab}/{cab}.resS'
+    names = [f'atlas{n}_{m}' for m in range(len(texture_formats))]
+    dicing = make_dicing(rng, names, (128, 96), 6, (80, 60), 32, 2)
+    objects = [(1, 114, OTHER_NODES, {
+      **make_dicing_value({}), 'm_Name': 'other', 'speed': 1.5, 'flag': True
+    })]
+    resource = bytearray()
+    for m, (name, texture_format) in enumerate(zip(names, texture_formats)):
+      # few distinct values, so LZ4 finds matches
+      atlas = make_atlas(rng, (128, 96)).point(lambda value: value & 0xC0)
+      if texture_format == 3:
+        atlas.putalpha(255)
+      atlases[name] = atlas
+      data = get_texture_data(atlas, texture_format); stream = None
+      if streamed:
+        resource += bytes(-len(resource) % 16)
+        stream = (stream_path, len(resource)); resource += data
+      objects.append(
+        (2 + m, 28, TEXTURE_NODES,
+          make_texture(name, atlas, texture_format, data, stream))
+      )
+    # never named by a dicing, so never decoded despite its bogus format
+    objects.append((10, 28, TEXTURE_NODES, make_texture(
+      f'unused{n}', atlas, 9999, get_texture_data(atlas, 4)
+    )))
+    objects.append((11, 114, DICING_NODES, make_dicing_value(dicing)))
+    del dicing['m_Enabled']; dicings.append(dicing)
+    nodes.append((cab, make_serialized(version, endian, objects), 4))
+    if streamed:
+      nodes.append((cab + '.resS', bytes(resource), 0))
+  bundle = make_bundle(
+    nodes, bundle_version, info_compression, data_compression, info_at_end,
+    padded
+  )
+  return bundle, dicings, atlases
+
+def check_layout(bundle_path, dicings, atlases):
+  # list of mismatches between what was written and what is read back
+  problems = list()
+  with open(bundle_path, 'rb') as f:
+    read_dicings, textures = undice_unityfs.get_dicentex_from_bundle(f)
+    read_dicings = [
+      {key: dicing[key] for key in ('cellSize', 'padding', 'textureDataList')}
+      for dicing in read_dicings
+    ]
+    if read_dicings != dicings:
+      problems.append('dicings differ')
+    if sorted(textures) != sorted(atlases):
+      problems.append(f'textures {sorted(textures)}, not {sorted(atlases)}')
+    for name in sorted(set(textures) & set(atlases)):
+      atlas = textures[name]().convert('RGBA')
+      if not np.array_equal(np.asarray(atlas), np.asarray(atlases[name])):
+        problems.append(f'{name} pixels differ')
+  return problems
+
+def run_checks(args):
+  rng = np.random.default_rng(args.seed); failed = 0
+  with tempfile.TemporaryDirectory() as tmpdir:
+    outfold = args.keep or tmpdir
+    os.makedirs(outfold, exist_ok=True)
+    for name, layout in LAYOUTS.items():
+      bundle, dicings, atlases = make_layout(rng, layout)
+      bundle_path = os.path.join(outfold, name + '.bundle')
+      with open(bundle_path, 'wb') as f:
+        f.write(bundle)
+      try:
+        problems = check_layout(bundle_path, dicings, atlases)
+      except Exception as e:
+        problems = [f'{type(e).__name__}: {e}']
+      print(f'{name}: ' + ('; '.join(problems) if problems else 'ok'))
+      failed += bool(problems)
+  return failed
+
+if __name__ == '__main__':
+  args = _init_parser().parse_args(sys.argv[1:])
+  if run_checks(args):
+    sys.exit(1)
@@ -0,0 +1,243 @@
+import os
+import sys
+import json
+import mmap
+import zlib
+import argparse
+from io import BytesIO
+from math import ceil
+from struct import pack, unpack
+
+import numpy as np
+from PIL import Image
+
+from undice_profile import stage
+
+# a variant store holds a tree of composited variants (see
+# undice_afterprocess.py -t 1d) as their first base, once, and for each
+# variant only the cells of a square grid over the image that differ from it:
+#   MAGIC, header length (uint32 LE), header JSON, then data
+# with header
+#   {'size': [w, h], 'cell_size': c,
+#    'base': {'name', 'offset', 'length'}, # PNG of the base
+#    'variants': {name: {
+#      'bbox': getbbox() of the variant or None, 'cells': [n, ...],
+#      'offset', 'length' # zlib of the cells' pixels, RGBA, one after another
+#    }}}
+# offsets counting from the start of data, cell n being row n // across, col
+# n % across of the grid (across = ceil(w / c)), cut short at the right and
+# bottom edges
+
+MAGIC = b'UNDVARS1'
+
+def _init_parser():
+  description = (
+    "Gets variants, or crops of them, out of variant stores written by "
+    "undice_afterprocess.py -t 1d."
+  )
+  parser = argparse.ArgumentParser(description=description)
+  parser.add_argument('store', type=str, help='path to a .variants file')
+  parser.add_argument(
+    'names', nargs='*', type=str,
+    help='variants to get (default all of them)'
+  )
+  parser.add_argument(
+    '-o', '--output-directory', default='variants/',
+    help='output directory to save variants into (default "variants/")'
+  )
+  parser.add_argument(
+    '--box', type=str, metavar='X0,Y0,X1,Y1',
+    help='only get this box of each variant'
+  )
+  parser.add_argument(
+    '--trim', action='store_true',
+    help="crop each variant to its non-transparent pixels, like -t 1 does"
+  )
+  parser.add_argument(
+    '--list', action='store_true', help=(
+      'list the variants with their trimmed box and how many cells they '
+      'differ from the base in, without getting any'
+    )
+  )
+  return parser
+
+## writing
+def get_canvas(im, box, size):
+  # array of a size canvas, blank but for im pasted at box
+  canvas = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+  if box is not None:
+    canvas[box[1]:box[3], box[0]:box[2]] = np.asarray(im.convert('RGBA'))
+  return canvas
+
+def get_changed_cells(base, variant, cell_size):
+  # numbers of the cells where the two arrays differ
+  height, width = base.shape[:2]
+  down = ceil(height / cell_size); across = ceil(width / cell_size)
+  changed = np.zeros((down * cell_size, across * cell_size), dtype=bool)
+  changed[:height, :width] = (base != variant).any(axis=2)
+  return np.flatnonzero(
+    changed.reshape(down, cell_size, across, cell_size).any(axis=(1, 3))
+  )
+
+def iter_cell_boxes(cells, size, cell_size):
+  width, height = size
+  across = ceil(width / cell_size)
+  for cell in cells:
+    x0 = cell % across * cell_size; y0 = cell // across * cell_size
+    yield (
+      x0, y0, min(x0 + cell_size, width), min(y0 + cell_size, height)
+    )
+
+def pack_cells(variant, cells, cell_size):
+  size = variant.shape[1], variant.shape[0]
+  return b''.join(
+    variant[y0:y1, x0:x1].tobytes()
+    for x0, y0, x1, y1 in iter_cell_boxes(cells, size, cell_size)
+  )
+
+def write_store(path, base, variants, cell_size=32, base_name=None):
+  # base is the PILimg variants are diffed against; variants are (name,
+  # PILimg, box) of images cropped to box of a canvas base's size and blank
+  # elsewhere, as iter_composited_tree(..., boxes=True) gives them; only
+  # the base's non-transparent box of pixels is kept, like variants'
+  size = base.size
+  base = get_canvas(base.crop(base.getbbox()), base.getbbox(), size)
+  header = {
+    'size': list(size), 'cell_size': cell_size,
+    'base': {'name': base_name}, 'variants': dict()
+  }
+  blobs = list(); offset = 0
+  for name, im, box in variants:
+    if im.size != (box[2] - box[0], box[3] - box[1]):
+      raise ValueError('images do not match')
+    with stage('delta') as counts:
+      counts['pixels'] = size[0] * size[1]
+      variant = get_canvas(im, box, size)
+      cells = get_changed_cells(base, variant, cell_size)
+      blob = zlib.compress(pack_cells(variant, cells, cell_size))
+      bbox = im.getbbox()
+    header['variants'][name] = {
+      'bbox': bbox and [
+        bbox[0] + box[0], bbox[1] + box[1], bbox[2] + box[0],
+        bbox[3] + box[1]
+      ],
+      'cells': cells.tolist(), 'offset': offset, 'length': len(blob)
+    }
+    blobs.append(blob); offset += len(blob)
+    del variant, im
+  with stage('save') as counts:
+    counts['pixels'] = size[0] * size[1]
+    buf = BytesIO()
+    Image.fromarray(base, 'RGBA').save(buf, 'PNG', optimize=True)
+    header['base'].update(offset=offset, length=buf.tell())
+    blobs.append(buf.getvalue())
+    header = json.dumps(header).encode()
+    with open(path, 'wb') as f:
+      f.write(MAGIC + pack('<I', len(header)) + header)
+      for blob in blobs:
+        f.write(blob)
+    counts['bytes_out'] = len(MAGIC) + 4 + len(header) + offset + buf.tell()
+
+## reading
+class VariantStore:
+  # a store from write_store, getting variants, or boxes of them, out on
+  # demand; the base is decoded once, on first use
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if self.data[:len(MAGIC)] != MAGIC:
+      raise ValueError(f'{path} is not a variant store!')
+    header_len, = unpack('<I', self.data[len(MAGIC):len(MAGIC) + 4])
+    self.data_start = len(MAGIC) + 4 + header_len
+    self.header = json.loads(self.data[len(MAGIC) + 4:self.data_start])
+    self.size = tuple(self.header['size'])
+    self.cell_size = self.header['cell_size']
+    self.names = list(self.header['variants'])
+    self.base = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def close(self):
+    self.data.close()
+
+  def read(self, entry):
+    start = self.data_start + entry['offset']
+    return self.data[start:start + entry['length']]
+
+  def get_base(self):
+    if self.base is None:
+      self.base = np.asarray(
+        Image.open(BytesIO(self.read(self.header['base']))).convert('RGBA')
+      )
+    return self.base
+
+  def get_bbox(self, name):
+    # box of the variant's non-transparent pixels, or None if it's blank
+    bbox = self.header['variants'][name]['bbox']
+    return bbox and tuple(bbox)
+
+  def get_array(self, name, box=None):
+    # (height, width, 4) array of variant name, or just box (x0, y0, x1,
+    # y1) of it, which may reach past the edges (those parts blank, as
+    # crop() has them)
+    entry = self.header['variants'][name]
+    x0, y0, x1, y1 = box or (0, 0) + self.size
+    width, height = self.size
+    out = np.zeros((y1 - y0, x1 - x0, 4), dtype=np.uint8)
+    # the part of box within the image
+    ix0 = max(x0, 0); iy0 = max(y0, 0)
+    ix1 = min(x1, width); iy1 = min(y1, height)
+    if ix0 >= ix1 or iy0 >= iy1:
+      return out
+    out[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = \
+      self.get_base()[iy0:iy1, ix0:ix1]
+    if not entry['cells']:
+      return out
+    pixels = zlib.decompress(self.read(entry))
+    offset = 0
+    for cx0, cy0, cx1, cy1 in iter_cell_boxes(
+      entry['cells'], self.size, self.cell_size
+    ):
+      nbytes = (cx1 - cx0) * (cy1 - cy0) * 4
+      # only cells reaching into the box are unpacked
+      if cx0 < ix1 and cx1 > ix0 and cy0 < iy1 and cy1 > iy0:
+        cell = np.frombuffer(
+          pixels, np.uint8, nbytes, offset
+        ).reshape(cy1 - cy0, cx1 - cx0, 4)
+        px0 = max(cx0, ix0); py0 = max(cy0, iy0)
+        px1 = min(cx1, ix1); py1 = min(cy1, iy1)
+        out[py0 - y0:py1 - y0, px0 - x0:px1 - x0] = \
+          cell[py0 - cy0:py1 - cy0, px0 - cx0:px1 - cx0]
+      offset += nbytes
+    return out
+
+  def get(self, name, box=None, trim=False):
+    # variant name as an RGBA PILimg, whole, just box, or with trim, just
+    # its non-transparent pixels (a blank one whole, as -t 1 saves it)
+    if trim:
+      box = self.get_bbox(name)
+    return Image.fromarray(self.get_array(name, box), 'RGBA')
+
+if __name__ == '__main__':
+  args = _init_parser().parse_args(sys.argv[1:])
+  box = args.box and tuple(int(n) for n in args.box.split(','))
+  with VariantStore(args.store) as store:
+    for name in args.names or store.names:
+      if not name in store.header['variants']:
+        print(name, 'not in', args.store)
+        continue
+      if args.list:
+        print(
+          name, store.get_bbox(name),
+          len(store.header['variants'][name]['cells']), 'cells'
+        )
+        continue
+      os.makedirs(args.output_directory, exist_ok=True)
+      outpath = os.path.join(args.output_directory, name + '.png')
+      store.get(name, box, args.trim).save(outpath, optimize=True)
+      print(outpath, 'saved!')